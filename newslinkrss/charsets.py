@@ -0,0 +1,339 @@
+#
+# newslinkrss - RSS feed generator for generic sites
+# Copyright (C) 2020  Alexandre Erwin Ittner <alexandre@ittner.com.br>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+"""Finding the character encoding of downloaded pages from their bytes.
+
+The encoding is taken from, in this order: the one given by the user, a
+byte order mark, the Content-Type header, a <meta> element at the start
+of the page, the encoding used before for pages from the same host and,
+as the last resort, detected from a sample of the page. The encodings
+used are remembered by host in 'host_cache', which may be loaded from and
+saved to a file, so detection is rarely needed twice for the same site.
+"""
+
+import codecs
+import logging
+import re
+import threading
+import urllib.parse
+
+try:
+    import charset_normalizer
+except ImportError:
+    # Usually installed with requests; without it, pages without any
+    # charset information are assumed to be UTF-8 or Windows-1252.
+    charset_normalizer = None
+
+from . import stats
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+BOMS = (
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+# Amount of the page searched for a <meta> element declaring the charset.
+# The HTML standard says 1024 bytes, but too many pages have lots of other
+# stuff before it.
+META_SCAN_SIZE = 4096
+
+# Amount of the page used for detecting the encoding, when everything else
+# fails.
+DETECT_SAMPLE_SIZE = 32 * 1024
+
+META_CHARSET_RX = re.compile(
+    rb"""<meta\s[^>]*?charset\s*=\s*["']?\s*([-\w.:]+)[^>]*>""", re.IGNORECASE
+)
+
+# Encodings that browsers replace with others, as in the HTML standard.
+# UTF-16 in a <meta> element is impossible, as it could not have been read.
+ENCODING_REPLACEMENTS = {
+    "iso8859_1": "cp1252",
+    "ascii": "cp1252",
+}
+META_ENCODING_REPLACEMENTS = {
+    **ENCODING_REPLACEMENTS,
+    "utf_16": "utf_8",
+    "utf_16_le": "utf_8",
+    "utf_16_be": "utf_8",
+}
+
+NON_ASCII_RX = re.compile(rb"[\x80-\xff]")
+
+
+def normalize_encoding(label, replacements=ENCODING_REPLACEMENTS):
+    """Return the Python codec name for an encoding label, or None if it is
+    not supported. Names found in 'replacements' are replaced by their
+    values, so an empty one gives the codec for the label as it is.
+    """
+    try:
+        name = codecs.lookup(label.strip()).name
+    except (LookupError, ValueError):
+        logger.info("Unknown encoding %s", label)
+        return None
+    name = name.replace("-", "_")
+    return replacements.get(name, name)
+
+
+def find_bom_encoding(data):
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return encoding
+    return None
+
+
+def find_header_encoding(content_type):
+    """Return the encoding from the charset parameter of a Content-Type
+    header, or None if it has none.
+    """
+    if not content_type:
+        return None
+    for param in content_type.split(";")[1:]:
+        key, _, value = param.partition("=")
+        if key.strip().lower() == "charset":
+            return normalize_encoding(value.strip(" \"'"))
+    return None
+
+
+def find_meta_encoding(data):
+    match = META_CHARSET_RX.search(data, 0, META_SCAN_SIZE)
+    if not match:
+        return None
+    return normalize_encoding(
+        match.group(1).decode("ascii", "replace"), META_ENCODING_REPLACEMENTS
+    )
+
+
+def can_decode(data, encoding, complete):
+    try:
+        codecs.getincrementaldecoder(encoding)().decode(data, complete)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def detect_encoding(sample, complete):
+    """Guess the encoding of a sample of text. Valid UTF-8 (including pure
+    ASCII) is the common case and is checked first, as detection is slow.
+    """
+    if can_decode(sample, "utf_8", complete):
+        return "utf_8"
+    if charset_normalizer is not None:
+        best = charset_normalizer.from_bytes(sample).best()
+        if best is not None:
+            return normalize_encoding(best.encoding) or "cp1252"
+    return "cp1252"
+
+
+class HostCharsetCache:
+    """The encodings used by pages of every host, optionally kept in a
+    file with a host name and encoding per line.
+    """
+
+    def __init__(self):
+        self._encodings = {}
+        self._changed = set()
+        self._lock = threading.Lock()
+
+    def get(self, host):
+        with self._lock:
+            return self._encodings.get(host)
+
+    def set(self, host, encoding):
+        with self._lock:
+            if self._encodings.get(host) != encoding:
+                self._encodings[host] = encoding
+                self._changed.add(host)
+
+    @staticmethod
+    def _read_file(filename):
+        encodings = {}
+        try:
+            with open(filename, encoding="utf-8") as fp:
+                for line in fp:
+                    fields = line.split()
+                    if len(fields) == 2:
+                        encodings[fields[0]] = fields[1]
+        except FileNotFoundError:
+            pass
+        except OSError:
+            logger.exception("Failed to read charset cache %s", filename)
+        return encodings
+
+    def load(self, filename):
+        """Add the entries from a file, keeping the ones already known."""
+        encodings = self._read_file(filename)
+        with self._lock:
+            for host, encoding in encodings.items():
+                self._encodings.setdefault(host, encoding)
+        logger.info("Loaded %d encodings from %s", len(encodings), filename)
+
+    def save(self, filename):
+        """Save the entries changed since loaded, keeping the ones added to
+        the file by other processes meanwhile.
+        """
+        with self._lock:
+            if not self._changed:
+                return
+            changed = {host: self._encodings[host] for host in self._changed}
+            self._changed = set()
+        with utils.file_lock(filename):
+            encodings = self._read_file(filename)
+            encodings.update(changed)
+            data = "".join("%s\t%s\n" % entry for entry in sorted(encodings.items()))
+            try:
+                utils.write_file_atomically(filename, data.encode("utf-8"))
+            except OSError:
+                logger.exception("Failed to save charset cache %s", filename)
+
+
+host_cache = HostCharsetCache()
+
+
+def resolve_encoding(url, content_type, data, complete, forced=None):
+    """Find the encoding of a page from its URL, Content-Type header, and
+    the first bytes of its body ('complete' tells if they are all of it).
+    Returns the encoding and where it came from, or (None, None) if more
+    data is needed to decide.
+    """
+    if forced:
+        encoding = normalize_encoding(forced, {})
+        if encoding:
+            return encoding, "option"
+    if len(data) < 3 and not complete:
+        return None, None
+    encoding = find_bom_encoding(data)
+    if encoding:
+        return encoding, "bom"
+    host = urllib.parse.urlsplit(url).hostname
+    encoding, source = find_header_encoding(content_type), "header"
+    if not encoding:
+        encoding, source = find_meta_encoding(data), "meta"
+    if not encoding and len(data) < META_SCAN_SIZE and not complete:
+        return None, None
+    if not encoding:
+        return guess_encoding(host, data, complete)
+    if host:
+        host_cache.set(host, encoding)
+    return encoding, source
+
+
+def guess_encoding(host, data, complete):
+    """Find the encoding of a page that does not declare one, as
+    resolve_encoding(). The data may also be just the part of the page
+    after its first non-ASCII byte, as everything before it is the same in
+    any encoding that could be guessed.
+    """
+    if data.isascii() and not complete:
+        # Nothing to be learned from it yet.
+        return None, None
+    if not data.isascii() and can_decode(data, "utf_8", complete):
+        # Non-ASCII text that is valid UTF-8 is almost never anything else,
+        # even if other pages from the same site are.
+        encoding, source = "utf_8", "detected"
+    else:
+        encoding = host_cache.get(host)
+        if encoding and can_decode(data, encoding, complete):
+            stats.count("charset_cache_hits")
+            return encoding, "cache"
+        if len(data) < DETECT_SAMPLE_SIZE and not complete:
+            return None, None
+        stats.count("charset_cache_misses")
+        encoding, source = (
+            detect_encoding(data[:DETECT_SAMPLE_SIZE], complete),
+            "detected",
+        )
+        stats.count("charset_detections")
+    if host:
+        host_cache.set(host, encoding)
+    return encoding, source
+
+
+class StreamDecoder:
+    """Incrementally decodes a page downloaded in chunks of bytes. The
+    first chunks are kept until resolve_encoding() can find the encoding.
+
+    If the page declares no encoding, the text is given as it arrives up to
+    its first non-ASCII byte, which is the same in any encoding that could
+    be guessed for it, and only the bytes from there on are kept until the
+    encoding is known; so pure ASCII pages are never held back.
+    """
+
+    def __init__(self, url, content_type, forced=None):
+        self.url = url
+        self.content_type = content_type
+        self.forced = forced
+        self.encoding = None
+        self._pending = b""
+        self._decoder = None
+        self._undeclared = False
+
+    def _take_ascii(self):
+        """Remove the ASCII text from the start of the pending bytes and
+        return it.
+        """
+        match = NON_ASCII_RX.search(self._pending)
+        end = match.start() if match else len(self._pending)
+        text = self._pending[:end].decode("ascii")
+        self._pending = self._pending[end:]
+        return text
+
+    def decode(self, data, final=False):
+        """Return the text for a chunk of bytes; it may be empty while the
+        encoding is not known.
+        """
+        if self._decoder is None:
+            self._pending += data
+            if not self._undeclared:
+                encoding, source = resolve_encoding(
+                    self.url, self.content_type, self._pending, final, self.forced
+                )
+                if encoding is None and len(self._pending) >= META_SCAN_SIZE:
+                    # Nothing declared, as it would have been found by now.
+                    self._undeclared = True
+            text = ""
+            if self._undeclared:
+                text = self._take_ascii()
+                # Wait for a few bytes past the first non-ASCII one, as a
+                # lone byte is too easily valid UTF-8.
+                if final or len(self._pending) >= 4:
+                    host = urllib.parse.urlsplit(self.url).hostname
+                    encoding, source = guess_encoding(host, self._pending, final)
+                else:
+                    encoding = None
+            if encoding is None:
+                return text
+            logger.debug("Encoding for %s is %s (%s)", self.url, encoding, source)
+            self.encoding = encoding
+            self._decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+            data, self._pending = self._pending, b""
+            return text + self._decoder.decode(data, final)
+        return self._decoder.decode(data, final)
+
+    def flush(self):
+        """Return the text for the bytes kept while the encoding was not
+        known, if the download ended before it was found. An incomplete
+        character at the end of a truncated download is just dropped.
+        """
+        if self._decoder is None:
+            return self.decode(b"", final=True)
+        return ""
@@ -26,6 +26,14 @@ from .defs import USER_LOG_LEVELS, DEFAULT_USER_AGENT
 logger = logging.getLogger(__name__)
 
 
+def positive_int(value):
+    """Argument type for numbers that must be at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, not %s" % value)
+    return number
+
+
 def make_parser():
     """Make the command line argument parser."""
 
@@ -467,6 +475,53 @@ def make_parser():
         help=("Define a log level. Valid values are " + ", ".join(USER_LOG_LEVELS)),
     )
 
+    parser.add_argument(
+        "--log-format",
+        action="store",
+        default="text",
+        choices=["text", "json"],
+        help=(
+            "Format for log messages. With 'json', every message is written "
+            "as a JSON object in a single line and the messages for pages "
+            "downloaded and items made (with option --log info) have fields "
+            "with the URL, status, size and duration, for processing by "
+            "other programs."
+        ),
+    )
+
+    parser.add_argument(
+        "--trace-file",
+        action="store",
+        default=None,
+        metavar="FILENAME",
+        help=(
+            "Append a trace with the time spent in every step of the feed "
+            "generation (downloads, parsing, etc.) to this file, as a line "
+            "of JSON in the OpenTelemetry Protocol format, which can be "
+            "loaded into tracing tools."
+        ),
+    )
+
+    parser.add_argument(
+        "--profile",
+        action="store",
+        default=None,
+        choices=("cpu", "mem"),
+        help=(
+            "Profile the generation of the feed and write a report next to "
+            "the output file (or to files named 'newslinkrss.*' in the "
+            "current directory if writing to stdout). With 'cpu', the "
+            "profile is written to OUTPUT.pstats, for the pstats module "
+            "or other tools, and a summary with the CPU time taken by every "
+            "stage (downloads, parsing, body extraction, etc.) to "
+            "OUTPUT.cpu.txt. With 'mem', the top memory allocations, also "
+            "split by stage, are written to OUTPUT.mem.txt. Profiling "
+            "slows everything down and does not cover the parsing done "
+            "in the worker processes from --cpu-workers, which is only "
+            "counted in --stats and --trace-file."
+        ),
+    )
+
     parser.add_argument(
         "--test",
         action="store_true",
@@ -478,6 +533,40 @@ def make_parser():
         ),
     )
 
+    parser.add_argument(
+        "--test-follow",
+        action="store",
+        default=0,
+        type=int,
+        metavar="NUMBER",
+        help=(
+            "With option --test, also follow the first NUMBER links that "
+            "would be followed and print the title, date (and where it was "
+            "found), author, categories and description size extracted "
+            "for them, with the time taken for downloading and parsing "
+            "every page. This uses the options for following links even "
+            "if --follow is not given."
+        ),
+    )
+
+    parser.add_argument(
+        "--interactive",
+        action="store",
+        nargs="?",
+        const=5,
+        default=None,
+        type=positive_int,
+        metavar="PAGES",
+        help=(
+            "Do not generate the feed, but download the start pages and the "
+            "first PAGES (default: 5) followed pages and start an "
+            "interactive shell where the extraction options (title, dates, "
+            "body, etc.) can be changed and their results checked against "
+            "these pages without downloading them again. PAGES must be at "
+            "least 1."
+        ),
+    )
+
     parser.add_argument(
         "-f",
         "--follow",
@@ -491,6 +580,23 @@ def make_parser():
         ),
     )
 
+    parser.add_argument(
+        "--cpu-workers",
+        action="store",
+        default=0,
+        type=int,
+        metavar="NUMBER",
+        help=(
+            "Number of worker processes used to parse pages followed when "
+            "using option --follow. By default, pages are parsed by the "
+            "main process, one after another, between downloads; with two "
+            "or more workers, pages are parsed in parallel while the next "
+            "ones are downloaded. This is only worth for feeds with many "
+            "heavy pages, typically with --with-body, on systems with "
+            "several CPUs."
+        ),
+    )
+
     parser.add_argument(
         "-B",
         "--with-body",
@@ -662,6 +768,74 @@ def make_parser():
         ),
     )
 
+    parser.add_argument(
+        "--max-link-age",
+        action="store",
+        default=None,
+        type=float,
+        metavar="DAYS",
+        help=(
+            "Ignore links with a date older than this number of days, as "
+            "found from options --date-from-text or --date-from-url, before "
+            "following them. Links without a date are kept."
+        ),
+    )
+
+    parser.add_argument(
+        "--sort-links",
+        action="store_true",
+        default=False,
+        help=(
+            "Sort the links found by their dates, as found from options "
+            "--date-from-text or --date-from-url, newest first, before "
+            "following them. Links without a date go last."
+        ),
+    )
+
+    parser.add_argument(
+        "--max-follow",
+        action="store",
+        default=None,
+        type=int,
+        metavar="NUMBER",
+        help=(
+            "Maximum number of links to turn into feed items (i.e. to "
+            "follow, when using --follow), after they are filtered and "
+            "sorted by options --max-link-age and --sort-links. Unlike "
+            "--max-links, this is applied after all start pages were "
+            "processed, so together with --sort-links it allows following "
+            "only the newest links. By default, there is no limit."
+        ),
+    )
+
+    parser.add_argument(
+        "--dedup-content",
+        action="store_true",
+        default=False,
+        help=(
+            "Detect followed pages with the same contents reached from "
+            "different URLs (e.g. with tracking parameters, AMP or mobile "
+            "versions) by their canonical URL or by a hash of their title "
+            "and text, and add only the first one to the feed. Pages are "
+            "downloaded entirely for this. This only works with option "
+            "--follow."
+        ),
+    )
+
+    parser.add_argument(
+        "--dedup-index",
+        action="store",
+        default=None,
+        metavar="FILE",
+        help=(
+            "Keep the contents seen by option --dedup-content in this file, "
+            "so an article found under a different URL in a later run is "
+            "published with the same GUID used when it was first seen, "
+            "instead of showing up again in the feed reader. The file may "
+            "be shared by several feeds."
+        ),
+    )
+
     parser.add_argument(
         "--require-dates",
         action="store_true",
@@ -723,6 +897,122 @@ def make_parser():
         ),
     )
 
+    parser.add_argument(
+        "--link-source",
+        action="store",
+        default="html",
+        choices=["html", "sitemap", "feed"],
+        help=(
+            "Where links are collected from. With 'html', links are taken "
+            "from the start pages as usual. With 'sitemap', start URLs are "
+            "sitemaps (or sitemap indexes, possibly gzipped) and links come "
+            "with the dates given in them. With 'feed', start URLs are RSS "
+            "or Atom feeds, or pages announcing one. Sitemaps and feeds are "
+            "usually much smaller than the HTML pages, and the newest links "
+            "are taken first. Patterns and other link options still apply."
+        ),
+    )
+
+    parser.add_argument(
+        "--next-page-xpath",
+        action="store",
+        default=None,
+        metavar="XPATH",
+        help=(
+            "Find links to the next index pages from this XPath expression "
+            "in every start page, for sites that list their links across "
+            "several pages. The expression may return either the elements "
+            "with the links or their 'href' attributes. Links in the next "
+            "pages are collected as if they were given as start URLs, up to "
+            "the limit set by --max-next-pages."
+        ),
+    )
+
+    parser.add_argument(
+        "--next-page-csss",
+        action="store",
+        default=None,
+        metavar="CSS_SELECTOR",
+        help=(
+            "Find links to the next index pages from this CSS Selector in "
+            "every start page, as with --next-page-xpath. If both options "
+            "are given, this one is only used when the XPath expression "
+            "returns nothing."
+        ),
+    )
+
+    parser.add_argument(
+        "--max-next-pages",
+        action="store",
+        default=5,
+        type=int,
+        metavar="NUMBER",
+        help=(
+            "Maximum depth of next pages to follow from the start pages "
+            "with options --next-page-xpath or --next-page-csss, i.e. the "
+            "maximum number of times 'next' is followed from any start "
+            "page. Following stops earlier if the limit set by --max-links "
+            "is reached. Default: 5."
+        ),
+    )
+
+    parser.add_argument(
+        "--index-workers",
+        action="store",
+        default=1,
+        type=positive_int,
+        metavar="NUMBER",
+        help=(
+            "Maximum number of start pages (and next pages found at the "
+            "same depth) downloaded at the same time. Links are still "
+            "collected in the order the pages were given. These downloads "
+            "share the same HTTP session, so cookies set by one page may "
+            "not be sent when downloading the others. Default: 1."
+        ),
+    )
+
+    parser.add_argument(
+        "--partial-download",
+        action="store_true",
+        default=False,
+        help=(
+            "When following links without --with-body, parse pages as they "
+            "are downloaded and stop once the elements given by the options "
+            "for title, date, author, and categories (e.g. --title-from-xpath, "
+            "--date-from-csss) were found, instead of downloading the entire "
+            "page. Only the first element matching each option is "
+            "considered, so this may miss dates or categories found later "
+            "in the page."
+        ),
+    )
+
+    parser.add_argument(
+        "--skip-non-html",
+        action="store_true",
+        default=False,
+        help=(
+            "When following links, check the Content-Type and "
+            "Content-Length headers of the response before downloading its "
+            "body and skip resources that are not HTML pages (e.g. PDFs, "
+            "images) or are larger than --max-page-length. These links are "
+            "still added to the feed, but with only the information "
+            "available without following them."
+        ),
+    )
+
+    parser.add_argument(
+        "--head-requests",
+        action="store_true",
+        default=False,
+        help=(
+            "Send a HEAD request before following every link, so resources "
+            "that are not HTML pages or are too large are detected before "
+            "even asking for their contents. This implies --skip-non-html "
+            "and costs an extra round-trip for every page, so it is only "
+            "worth for sites with many links to large files."
+        ),
+    )
+
     parser.add_argument(
         "--encoding",
         action="store",
@@ -734,6 +1024,20 @@ def make_parser():
         'in the wrong encoding (aka "mojibake").',
     )
 
+    parser.add_argument(
+        "--charset-cache",
+        action="store",
+        default=None,
+        metavar="FILENAME",
+        help=(
+            "File where the character encoding used by every site is kept "
+            "among runs. Pages that do not declare their encoding in the "
+            "HTTP headers or in a <meta> element are decoded with the one "
+            "used before for the same host, instead of guessing it again "
+            "from the page contents."
+        ),
+    )
+
     parser.add_argument(
         "--lang",
         action="append",
@@ -800,15 +1104,82 @@ def make_parser():
         help="Timeout for HTTP(S) requests, in seconds",
     )
 
+    parser.add_argument(
+        "--deadline",
+        action="store",
+        default=None,
+        type=float,
+        metavar="SECONDS",
+        help=(
+            "Maximum time, in seconds, for generating the entire feed. "
+            "Option --http-timeout only applies to each read from the "
+            "network, so a slow server or a long list of links to follow "
+            "can make the process run for a very long time. Once this "
+            "limit is reached, no more pages are downloaded, any ongoing "
+            "download is truncated, and the feed is written with the items "
+            "gathered so far. By default, there is no limit."
+        ),
+    )
+
+    parser.add_argument(
+        "--item-budget",
+        action="store",
+        default=None,
+        type=float,
+        metavar="SECONDS",
+        help=(
+            "Maximum time, in seconds, for downloading every page followed "
+            "when using option --follow. If the limit is exceeded, the "
+            "download is truncated and the item is built from the data "
+            "received so far. By default, there is no limit."
+        ),
+    )
+
+    parser.add_argument(
+        "--memory-budget",
+        action="store",
+        default=None,
+        type=int,
+        metavar="MEGABYTES",
+        help=(
+            "Limit the memory used for generating each feed to this "
+            "amount, in megabytes. Once exceeded, no more pages are sent to "
+            "the workers (see --cpu-workers) until they are done with the "
+            "ones they have; if it is still exceeded after that, no more "
+            "links are followed and the feed is written with the items found "
+            "so far, but it never replaces an existing output file. This "
+            "allows running many instances side by side on machines with "
+            "little memory. Only supported on systems with /proc. By "
+            "default, there is no limit."
+        ),
+    )
+
     parser.add_argument(
         "--no-cookies",
         action="store_true",
         default=False,
         help=(
-            "Do not remember cookies among requests. As cookies are never "
-            "persisted across invocations of this command, this will only "
-            "have any effect when using --follow, typically for sites that "
-            "use cookies to detect too many requests in a row."
+            "Do not remember cookies among requests. Unless option "
+            "--cookie-jar is used, cookies are never persisted across "
+            "invocations of this command, so this will only have any effect "
+            "when using --follow, typically for sites that use cookies to "
+            "detect too many requests in a row. With --cookie-jar, cookies "
+            "from the file are sent but the file is never changed."
+        ),
+    )
+
+    parser.add_argument(
+        "--cookie-jar",
+        action="store",
+        default=None,
+        metavar="FILENAME",
+        help=(
+            "Load cookies from this file before starting and save them back "
+            "once the feed is generated, so cookies set by a site (e.g. "
+            "after accepting a consent banner) are remembered across runs. "
+            "The file uses the Mozilla/Netscape format used by curl, wget, "
+            "etc. (LWP files are supported too) and may be shared by "
+            "concurrent runs."
         ),
     )
 
@@ -854,12 +1225,148 @@ def make_parser():
         ),
     )
 
+    parser.add_argument(
+        "--only-if-changed",
+        action="store_true",
+        default=False,
+        help=(
+            "Do not rewrite the output file if the feed did not change since "
+            "it was written, so its modification time and the date of the "
+            "last build in it are kept and feed readers, mirrors, caches, "
+            "etc. do not see a new version. Only makes sense with --output."
+        ),
+    )
+
+    parser.add_argument(
+        "--precompress",
+        action="append",
+        default=None,
+        choices=("gz", "br"),
+        help=(
+            "Also write a compressed copy of the output file, with the same "
+            "name plus extension '.gz' (gzip) or '.br' (Brotli, requires "
+            "Python module 'brotli'), ready to be served by web servers "
+            "that support pre-compressed files. May be given more than once "
+            "for both. Only makes sense with --output."
+        ),
+    )
+
+    parser.add_argument(
+        "--write-etag",
+        action="store_true",
+        default=False,
+        help=(
+            "Also write a file with the name of the output file plus "
+            "extension '.etag' and a hash of the feed contents, quoted for "
+            "use as a HTTP ETag header. It only changes when the contents "
+            "do. Only makes sense with --output."
+        ),
+    )
+
+    parser.add_argument(
+        "--batch",
+        action="store",
+        default=None,
+        metavar="FILENAME",
+        help=(
+            "Generate several feeds in a single run. Every line of the file "
+            "has the command line options and URLs for a feed, with the "
+            "same syntax used in the shell (empty lines and lines starting "
+            "with '#' are ignored), and options given in the actual command "
+            "line apply to all of them. Feeds are generated one after "
+            "another in the same process, sharing connections to the same "
+            "sites, so each one will usually need its own --output."
+        ),
+    )
+
+    parser.add_argument(
+        "--dns-cache-ttl",
+        action="store",
+        default=0,
+        type=float,
+        metavar="SECONDS",
+        help=(
+            "Cache host name resolution results for this number of seconds. "
+            "This is mostly useful with option --batch, where many feeds "
+            "are generated from the same sites. Zero disables the cache."
+        ),
+    )
+
+    parser.add_argument(
+        "--metrics-file",
+        action="store",
+        default=None,
+        metavar="FILENAME",
+        help=(
+            "Write metrics about the feeds generated (duration, requests "
+            "by status code, bytes downloaded, items emitted and skipped, "
+            "errors, etc.) to this file in the Prometheus text format, "
+            "e.g. for the textfile collector of node_exporter. The file is "
+            "replaced atomically once all feeds are done."
+        ),
+    )
+
+    parser.add_argument(
+        "--metrics-port",
+        action="store",
+        default=None,
+        type=int,
+        metavar="PORT",
+        help=(
+            "Serve the same metrics from option --metrics-file over HTTP, "
+            "at http://127.0.0.1:PORT/metrics, while newslinkrss runs. "
+            "This is mostly useful with option --batch."
+        ),
+    )
+
+    parser.add_argument(
+        "--record",
+        action="store",
+        default=None,
+        metavar="DIRECTORY",
+        help=(
+            "Save every HTTP response received (status, headers and body, "
+            "up to the largest of --max-page-length and "
+            "--max-first-page-length) into this directory, so the run can "
+            "be repeated later with option --replay."
+        ),
+    )
+
+    parser.add_argument(
+        "--replay",
+        action="store",
+        default=None,
+        metavar="DIRECTORY",
+        help=(
+            "Do not access the network, but take the HTTP responses from "
+            "a directory recorded with option --record; requests not found "
+            "there fail as connection errors. This makes runs fast and "
+            "repeatable, which is useful for tuning the options for a feed "
+            "or for benchmarking. Cookies set by the responses are ignored."
+        ),
+    )
+
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        default=False,
+        help=(
+            "Print statistics about the generation of the feed to stderr: "
+            "time taken, number of requests, HTTP status codes, amount of "
+            "data downloaded, connections opened and time spent setting "
+            "them up, etc."
+        ),
+    )
+
     parser.add_argument(
         "urls",
         action="store",
-        nargs="+",
+        nargs="*",
         metavar="URL",
-        help="URL of the website to generate the feed.",
+        help=(
+            "URL of the website to generate the feed. At least one is "
+            "required, unless option --batch is used."
+        ),
     )
 
     return parser
@@ -0,0 +1,145 @@
+#
+# newslinkrss - RSS feed generator for generic sites
+# Copyright (C) 2020  Alexandre Erwin Ittner <alexandre@ittner.com.br>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+"""Detection of items that reach the same content from different URLs.
+
+Every followed page gives a few fingerprints: its canonical URL, if any,
+and a hash of its normalized title and body text. Pages sharing any fingerprint
+are the same item; within a run, only the first one is kept and, across
+runs, the index file maps fingerprints to the GUID first used for them,
+so the same article is always published with the same GUID.
+"""
+
+import hashlib
+import logging
+import re
+import time
+
+from . import stats
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+WHITESPACE_RX = re.compile(r"\s+")
+
+# Entries not seen for this long are dropped from the index file.
+INDEX_MAX_AGE = 90 * 86400
+
+# Minimum length of the normalized text for a text fingerprint. Shorter
+# texts, as from pages with their contents built by scripts, are too
+# likely to be the same for different articles.
+MIN_TEXT_LENGTH = 200
+
+
+def normalize_text(text):
+    return WHITESPACE_RX.sub(" ", text or "").strip().lower()
+
+
+def content_fingerprints(canonical, title, text):
+    """Return the fingerprints for an item with the given canonical URL
+    (or None), title, and text.
+    """
+    fingerprints = []
+    if canonical:
+        fingerprints.append("url:" + canonical)
+    text = normalize_text(text)
+    if len(text) >= MIN_TEXT_LENGTH:
+        # The title alone is too often the site name to be trusted.
+        digest = hashlib.blake2b(
+            (normalize_text(title) + "\n" + text).encode("utf-8"), digest_size=16
+        )
+        fingerprints.append("text:" + digest.hexdigest())
+    return fingerprints
+
+
+class ContentIndex:
+    """Index of fingerprints to item GUIDs, optionally kept in a file."""
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._guids = {}
+        self._last_seen = {}
+        self._seen_keys = set()
+        self._emitted = set()
+        if filename:
+            self._guids, self._last_seen = self._read_file(filename)
+            logger.info("Loaded %d fingerprints from %s", len(self._guids), filename)
+
+    @staticmethod
+    def _read_file(filename):
+        guids = {}
+        last_seen = {}
+        try:
+            with open(filename, encoding="utf-8") as fp:
+                for line in fp:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) != 3:
+                        continue
+                    key, guid, timestamp = fields
+                    guids[key] = guid
+                    last_seen[key] = float(timestamp)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            logger.exception("Failed to read dedup index %s", filename)
+        return guids, last_seen
+
+    def resolve(self, fingerprints, guid):
+        """Return the GUID to use for an item with the given fingerprints and
+        original GUID, or None if it duplicates an item already seen in this
+        run.
+        """
+        for key in fingerprints:
+            if key in self._guids:
+                guid = self._guids[key]
+                stats.count("dedup_index_hits")
+                break
+        else:
+            stats.count("dedup_index_misses")
+        now = time.time()
+        for key in fingerprints:
+            self._guids.setdefault(key, guid)
+            self._last_seen[key] = now
+            self._seen_keys.add(key)
+        if guid in self._emitted:
+            return None
+        self._emitted.add(guid)
+        return guid
+
+    def save(self):
+        """Save the index file, keeping entries added by other processes
+        since it was loaded.
+        """
+        if not self.filename:
+            return
+        with utils.file_lock(self.filename):
+            guids, last_seen = self._read_file(self.filename)
+            for key in self._seen_keys:
+                guids[key] = self._guids[key]
+                last_seen[key] = self._last_seen[key]
+            min_timestamp = time.time() - INDEX_MAX_AGE
+            data = "".join(
+                "%s\t%s\t%d\n" % (key, guid, last_seen[key])
+                for key, guid in guids.items()
+                if last_seen[key] >= min_timestamp
+            )
+            try:
+                utils.write_file_atomically(self.filename, data.encode("utf-8"))
+            except OSError:
+                logger.exception("Failed to save dedup index %s", self.filename)
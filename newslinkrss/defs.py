@@ -22,3 +22,6 @@ DEFAULT_USER_AGENT = (
 )
 
 USER_LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL", "FATAL"]
+
+# MIME types of documents that we know how to parse when following links.
+HTML_CONTENT_TYPES = ["text/html", "application/xhtml+xml"]
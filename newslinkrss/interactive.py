@@ -0,0 +1,249 @@
+#
+# newslinkrss - RSS feed generator for generic sites
+# Copyright (C) 2020  Alexandre Erwin Ittner <alexandre@ittner.com.br>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+"""Interactive mode for tuning the extraction options for a feed.
+
+The start pages and a sample of the followed pages are downloaded and
+parsed only once; the options may then be changed and the results checked
+against the pages kept in memory, without accessing the site again.
+"""
+
+import cmd
+import copy
+import logging
+import shlex
+import time
+
+from . import records
+
+logger = logging.getLogger(__name__)
+
+
+class SamplePage:
+    """A followed page kept in memory, with its link and parsed data."""
+
+    def __init__(self, link, page, attr_parser, tree):
+        self.link = link
+        self.page = page
+        self.attr_parser = attr_parser
+        self.tree = tree
+
+
+class InteractiveShell(cmd.Cmd):
+    intro = (
+        "newslinkrss interactive mode. Type 'help' for the commands, 'quit' to exit."
+    )
+    prompt = "newslinkrss> "
+
+    def __init__(self, parser, args, transport, sample_size):
+        super().__init__()
+        self.parser = parser
+        self.args = args
+        self.transport = transport
+        self.sample_size = sample_size
+        self.links = []
+        self.samples = []
+
+    def print(self, *values):
+        print(*values, file=self.stdout)
+
+    def load(self):
+        """Download the start pages and the sample of followed pages."""
+        # Module main imports this one.
+        from . import main
+
+        args = self.args
+        session, _ = main.make_session(args, self.transport)
+        _, link_grabber = main.collect_links(args, session)
+        self.links = main.select_links(args, link_grabber.links)
+        self.samples = []
+        used_urls = set()
+        for link in self.links:
+            if len(self.samples) >= self.sample_size:
+                break
+            page = main.fetch_item_page(session, link, used_urls, args, full_page=True)
+            if not isinstance(page, records.Page):
+                continue
+            attr_parser, tree = main.parse_item_page(args, page, with_tree=True)
+            self.samples.append(SamplePage(link, page, attr_parser, tree))
+        self.print(
+            "%d links found, %d pages kept in memory."
+            % (len(self.links), len(self.samples))
+        )
+
+    def get_samples(self, arg):
+        """Return the samples selected by a page number in arg, or all."""
+        if not arg.strip():
+            return list(enumerate(self.samples))
+        try:
+            num = int(arg)
+            return [(num, self.samples[num])]
+        except (ValueError, IndexError):
+            self.print("Invalid page number: %s" % arg)
+            return []
+
+    def emptyline(self):
+        pass
+
+    def do_links(self, arg):
+        """links: list the links found in the start pages."""
+        for link in self.links:
+            self.print("- " + link.url)
+            if link.text:
+                self.print("    text: " + link.text)
+            if link.date:
+                self.print("    date: " + str(link.date))
+
+    def do_pages(self, arg):
+        """pages: list the pages kept in memory, with their numbers."""
+        for num, sample in enumerate(self.samples):
+            self.print(
+                "%3d %s (%d kB)" % (num, sample.page.url, len(sample.page.text) // 1024)
+            )
+
+    def do_items(self, arg):
+        """items [PAGE]: show the feed items made from the pages in memory
+        (or only from page number PAGE) with the current options.
+        """
+        from . import main
+
+        for num, sample in self.get_samples(arg):
+            start = time.monotonic()
+            item = main.make_item_from_parsed_page(
+                self.args, sample.page, sample.link, sample.attr_parser, sample.tree
+            )
+            elapsed = time.monotonic() - start
+            self.print("%3d %s" % (num, sample.page.url))
+            if item is None:
+                self.print("    ignored (no date, see --require-dates)")
+                continue
+            self.print("    title:      %s" % item.title)
+            self.print("    link:       %s" % item.link)
+            self.print("    date:       %s" % item.date)
+            self.print("    author:     %s" % item.author)
+            self.print("    categories: %s" % ", ".join(item.categories))
+            self.print("    description: %d characters" % len(item.description or ""))
+            self.print("    time:       %.1f ms" % (1000 * elapsed))
+
+    def do_body(self, arg):
+        """body PAGE: show the item body (or description) for page number
+        PAGE with the current options.
+        """
+        from . import main
+
+        samples = self.get_samples(arg) if arg.strip() else []
+        if not samples:
+            self.print("Usage: body PAGE")
+        for num, sample in samples:
+            item = main.make_item_from_parsed_page(
+                self.args, sample.page, sample.link, sample.attr_parser, sample.tree
+            )
+            self.print(item.description if item else "(ignored)")
+
+    def _show_results(self, kind, arg, evaluate):
+        if not arg.strip():
+            self.print("Usage: %s EXPRESSION" % kind)
+            return
+        for num, sample in enumerate(self.samples):
+            if sample.tree is None:
+                continue
+            try:
+                results = evaluate(sample.tree, arg)
+            except Exception as exc:
+                self.print("Error: %s" % exc)
+                return
+            self.print("%3d %s: %d results" % (num, sample.page.url, len(results)))
+            for res in results[:5]:
+                if hasattr(res, "text_content"):
+                    text = res.text_content()
+                else:
+                    text = str(res)
+                self.print("    " + " ".join(text.split())[:100])
+
+    def do_xpath(self, arg):
+        """xpath EXPRESSION: evaluate an XPath expression in all pages."""
+        self._show_results("xpath", arg, lambda tree, expr: tree.xpath(expr))
+
+    def do_css(self, arg):
+        """css SELECTOR: evaluate a CSS selector in all pages."""
+        self._show_results("css", arg, lambda tree, expr: tree.cssselect(expr))
+
+    def do_set(self, arg):
+        """set OPTIONS: change options, given as in the command line (e.g.
+        set --title-from-csss 'h1.title'). Options affecting links or
+        downloads only take effect after 'reload'.
+        """
+        try:
+            argv = shlex.split(arg)
+            args = self.parser.parse_args(argv, namespace=copy.copy(self.args))
+            # Positional arguments are always set, even if not given.
+            args.urls = args.urls or self.args.urls
+            self.args = args
+        except ValueError as exc:
+            self.print("Error: %s" % exc)
+        except SystemExit:
+            # argparse already printed the error.
+            pass
+
+    def do_unset(self, arg):
+        """unset OPTION...: restore options to their default values, given
+        by their long names (e.g. unset --title-from-csss).
+        """
+        args = copy.copy(self.args)
+        for name in arg.split():
+            dest = name.lstrip("-").replace("-", "_")
+            if not hasattr(args, dest):
+                self.print("Unknown option: %s" % name)
+                return
+            setattr(args, dest, self.parser.get_default(dest))
+        self.args = args
+
+    def do_options(self, arg):
+        """options: show the options changed from their default values."""
+        for dest, value in sorted(vars(self.args).items()):
+            if value != self.parser.get_default(dest) and dest not in (
+                "interactive",
+                "urls",
+            ):
+                self.print("--%s %s" % (dest.replace("_", "-"), value))
+
+    def do_reload(self, arg):
+        """reload: download the start pages and sample pages again."""
+        self.load()
+
+    def do_quit(self, arg):
+        """quit: exit the interactive mode."""
+        return True
+
+    def do_EOF(self, arg):
+        self.print("")
+        return True
+
+
+def run(parser, args, transport):
+    """Run the interactive mode; returns the process exit status."""
+    try:
+        # Enables line editing and history in the shell, if available.
+        import readline  # noqa: F401
+    except ImportError:
+        pass
+    shell = InteractiveShell(parser, args, transport, args.interactive)
+    shell.load()
+    shell.cmdloop()
+    return 0
@@ -0,0 +1,304 @@
+#
+# newslinkrss - RSS feed generator for generic sites
+# Copyright (C) 2020  Alexandre Erwin Ittner <alexandre@ittner.com.br>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+"""Links from sitemaps and feeds, as an alternative to scraping the links
+from HTML pages.
+
+Documents are parsed incrementally with a lxml pull parser while they are
+downloaded, so even large sitemaps are handled with little memory.
+"""
+
+import logging
+import time
+import zlib
+
+import lxml.etree
+
+from . import stats
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+SITEMAP_TYPES = ("urlset", "sitemapindex")
+
+FEED_TYPES = ("rss", "RDF", "feed")
+
+
+def local_name(elem):
+    return lxml.etree.QName(elem).localname
+
+
+def child_text(elem, *names):
+    """Return the stripped text of the first child of elem with any of the
+    given local names (in order of preference), or None.
+    """
+    for name in names:
+        for child in elem:
+            if isinstance(child.tag, str) and local_name(child) == name:
+                text = (child.text or "").strip()
+                if text:
+                    return text
+    return None
+
+
+def parse_entry_date(text):
+    if not text:
+        return None
+    try:
+        return utils.parse_date(text, "xml")
+    except (ValueError, OverflowError):
+        logger.debug("Invalid date in link source: %s", text)
+        return None
+
+
+class SourceDocument:
+    """Entries read from a sitemap or feed.
+
+    kind     - "sitemap", "feed", or None if the document is neither
+    title    - Feed title or None
+    links    - List of (url, text, date) tuples for the articles
+    sitemaps - List of (url, date) tuples with sitemaps from a sitemap index
+    """
+
+    def __init__(self):
+        self.kind = None
+        self.title = None
+        self.links = []
+        self.sitemaps = []
+
+    def _handle_url(self, elem):
+        loc = child_text(elem, "loc")
+        if not loc:
+            return True
+        news = None
+        for child in elem:
+            if isinstance(child.tag, str) and local_name(child) == "news":
+                news = child
+                break
+        title = ""
+        date_text = None
+        if news is not None:
+            title = child_text(news, "title") or ""
+            date_text = child_text(news, "publication_date")
+        date = parse_entry_date(date_text or child_text(elem, "lastmod"))
+        self.links.append((loc, title, date))
+        return True
+
+    def _handle_sitemap(self, elem):
+        loc = child_text(elem, "loc")
+        if loc:
+            self.sitemaps.append((loc, parse_entry_date(child_text(elem, "lastmod"))))
+        return True
+
+    def _handle_rss_item(self, elem):
+        link = child_text(elem, "link")
+        if not link:
+            # Some feeds only have a permalink GUID.
+            for child in elem:
+                if (
+                    isinstance(child.tag, str)
+                    and local_name(child) == "guid"
+                    and child.get("isPermaLink", "true") == "true"
+                ):
+                    link = (child.text or "").strip()
+        if link:
+            date = parse_entry_date(child_text(elem, "pubDate", "date", "updated"))
+            self.links.append((link, child_text(elem, "title") or "", date))
+        return True
+
+    def _handle_atom_entry(self, elem):
+        link = None
+        for child in elem:
+            if (
+                isinstance(child.tag, str)
+                and local_name(child) == "link"
+                and child.get("rel", "alternate") == "alternate"
+                and child.get("href")
+            ):
+                link = child.get("href").strip()
+                break
+        if link:
+            date = parse_entry_date(child_text(elem, "published", "updated"))
+            self.links.append((link, child_text(elem, "title") or "", date))
+        return True
+
+    def _handle_title(self, elem):
+        parent = elem.getparent()
+        if (
+            self.title is None
+            and parent is not None
+            and local_name(parent) in ("channel", "feed")
+        ):
+            self.title = (elem.text or "").strip() or None
+        # Titles from items are still needed by their handlers.
+        return False
+
+    def handlers_for(self, root_name):
+        """Return the handlers for the elements of a document with the given
+        root element, by local name, and set the document kind from it.
+        """
+        if root_name in SITEMAP_TYPES:
+            self.kind = "sitemap"
+            return {
+                "url": self._handle_url,
+                "sitemap": self._handle_sitemap,
+            }
+        if root_name in FEED_TYPES:
+            self.kind = "feed"
+            return {
+                "item": self._handle_rss_item,
+                "entry": self._handle_atom_entry,
+                "title": self._handle_title,
+            }
+        return {}
+
+
+class SourceStream:
+    """Parses a sitemap or feed into a SourceDocument as its bytes arrive,
+    given as chunks to calls of this object (as the consume_chunk callback
+    for main.do_session_http_get) and finished by close().
+
+    Gzipped documents are transparently decompressed, also limited to
+    max_bytes, or a tiny file could expand to an unlimited amount of data.
+    Handlers are called for every element once it is complete and elements
+    are freed after handling if the handler returns True, so memory does not
+    grow with the document size. Truncated documents are handled up to the
+    point where they were cut.
+
+    If 'keep_data' is set (e.g. for HTML pages), the document is not parsed
+    but kept in 'data'. The number of bytes given is kept in 'received'.
+    """
+
+    def __init__(self, doc, max_bytes):
+        self.doc = doc
+        self.remaining = max_bytes
+        self.keep_data = False
+        self.data = b""
+        self.truncated = False
+        self.received = 0
+        self.root_name = None
+        self._handlers = {}
+        self._head = b""
+        self._started = False
+        self._decompressor = None
+        self._failed = False
+        self._parse_time = 0.0
+        self._parser = lxml.etree.XMLPullParser(
+            events=("start", "end"),
+            resolve_entities=False,
+            no_network=True,
+            recover=False,
+        )
+
+    def __call__(self, data):
+        self.received += len(data)
+        if not self._started:
+            # Wait for enough bytes to know if it is gzipped.
+            self._head += data
+            if len(self._head) < len(GZIP_MAGIC):
+                return
+            data, self._head = self._head, b""
+            self._started = True
+            if data.startswith(GZIP_MAGIC):
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self._decompressor is not None:
+            if self.remaining <= 0:
+                self.truncated = True
+                return
+            try:
+                data = self._decompressor.decompress(data, max(1, self.remaining))
+            except zlib.error:
+                logger.exception("When decompressing link source document")
+                self._failed = True
+                return
+            if self._decompressor.unconsumed_tail:
+                self.truncated = True
+        self._consume(data)
+
+    def _consume(self, data):
+        if self.remaining <= 0 or self._failed:
+            self.truncated = self.truncated or bool(data)
+            return
+        if len(data) > self.remaining:
+            data = data[: self.remaining]
+            self.truncated = True
+        self.remaining -= len(data)
+        if self.keep_data:
+            self.data += data
+            return
+        start = time.monotonic()
+        try:
+            self._parser.feed(data)
+            self._handle_events()
+        except lxml.etree.XMLSyntaxError:
+            self._failed = True
+            self._syntax_error()
+        self._parse_time += time.monotonic() - start
+
+    def _handle_events(self):
+        for event, elem in self._parser.read_events():
+            if not isinstance(elem.tag, str):
+                continue
+            if event == "start":
+                if self.root_name is None:
+                    self.root_name = local_name(elem)
+                    self._handlers = self.doc.handlers_for(self.root_name)
+                continue
+            handler = self._handlers.get(local_name(elem))
+            if handler and handler(elem):
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+    def _syntax_error(self):
+        if self.truncated:
+            logger.warning("Link source document was truncated")
+        elif self.root_name is not None:
+            logger.exception("When parsing link source document")
+        # Otherwise, it is not XML at all.
+
+    def close(self, truncated=False):
+        """Finish parsing once the download ends; 'truncated' tells if it
+        was cut short (e.g. by a time limit). Returns the document.
+        """
+        self.truncated = self.truncated or truncated
+        if not self._started:
+            self._started = True
+            self._consume(self._head)
+        elif self._decompressor is not None and not self._failed:
+            self._consume(self._decompressor.flush())
+        if not self.keep_data and not self._failed:
+            start = time.monotonic()
+            try:
+                self._parser.close()
+                self._handle_events()
+            except lxml.etree.XMLSyntaxError:
+                self._syntax_error()
+            self._parse_time += time.monotonic() - start
+        stats.add_time("link_source_parse", self._parse_time)
+        logger.debug(
+            "Parsed %s document in %.3fs: %d links, %d sitemaps",
+            self.root_name,
+            self._parse_time,
+            len(self.doc.links),
+            len(self.doc.sitemaps),
+        )
+        return self.doc
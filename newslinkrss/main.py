@@ -20,13 +20,24 @@
 
 import sys
 import os
+import collections
+import concurrent.futures
 import datetime
+import time
 import copy
+import gc
+import gzip
+import hashlib
+import functools
+import math
 import locale
 import logging
+import re
+import shlex
 import traceback
 import http.cookiejar
 import http.cookies
+import io
 import urllib3
 
 import dateutil.parser
@@ -39,18 +50,39 @@ import lxml.etree
 import lxml.cssselect
 import cssselect
 
+try:
+    import brotli
+except ImportError:
+    # Optional, only needed for --precompress br.
+    brotli = None
 
-from .defs import USER_LOG_LEVELS, DEFAULT_USER_AGENT
+
+from .defs import USER_LOG_LEVELS, DEFAULT_USER_AGENT, HTML_CONTENT_TYPES
+from . import charsets
 from . import cliargs
+from . import dedup
+from . import interactive
+from . import linksources
+from . import logs
+from . import metrics
 from . import parsers
+from . import profiling
+from . import records
+from . import stats
+from . import tracing
 from . import utils
+from .transport import Transport
+
 
+# Marks the end of the document <head>, explicit or implicit.
+HEAD_END_RX = re.compile(r"</head\s*>|<body[\s>]", re.I)
 
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
 def set_log_level(args):
+    logs.set_log_format(args.log_format)
     if not args.log:
         return
     level = args.log.upper()
@@ -76,18 +108,24 @@ def post_process_item_body(args, body):
             res = body.xpath(expr)
             if res:
                 for elem in res:
-                    logger.debug(
-                        "body-remove-xpath %s matched: deleting element %s", expr, elem
-                    )
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(
+                            "body-remove-xpath %s matched: deleting element %s",
+                            expr,
+                            elem,
+                        )
                     elem.getparent().remove(elem)
     if args.body_remove_csss:
         for expr in args.body_remove_csss:
             res = body.cssselect(expr)
             if res:
                 for elem in res:
-                    logger.debug(
-                        "body-remove-csss %s matched: deleting element %s", expr, elem
-                    )
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(
+                            "body-remove-csss %s matched: deleting element %s",
+                            expr,
+                            elem,
+                        )
                     elem.getparent().remove(elem)
     if args.body_rename_tag:
         for old_tag, new_tag in args.body_rename_tag:
@@ -101,29 +139,135 @@ def post_process_item_body(args, body):
                     del e.attrib[old_attr_name]
 
 
-def make_item_body(args, page_text, tree):
+def needs_document_tree(args):
+    """Return True if the options require the entire document parsed as a
+    tree to make the items, instead of only the metadata from its <head>.
+    """
+    return bool(
+        args.with_body
+        or args.dedup_content
+        or args.title_from_xpath
+        or args.title_from_csss
+        or args.date_from_xpath
+        or args.date_from_csss
+        or args.author_from_xpath
+        or args.author_from_csss
+        or args.categories_from_xpath
+        or args.categories_from_csss
+    )
+
+
+def head_end_found(page_text, chunk_start):
+    """Stop condition for do_session_http_get() that is satisfied once the
+    end of the document <head> arrives.
+    """
+    # Also look at the end of the previous chunk, as the tag may be split.
+    return bool(HEAD_END_RX.search(page_text, max(0, chunk_start - 8)))
+
+
+class SelectorsFoundCheck:
+    """Stop condition for do_session_http_get() that parses the page as it
+    arrives and is satisfied once the XPath expressions and CSS selectors
+    given for title, date, author and categories matched a *complete*
+    element (i.e. with its closing tag already parsed).
+
+    Only the first match is checked, so a date that fails to parse or
+    categories scattered through the page may be missed.
+    """
+
+    def __init__(self, args):
+        self._groups = []
+        for xpath, csss in (
+            (args.title_from_xpath, args.title_from_csss),
+            (args.date_from_xpath, args.date_from_csss),
+            (args.author_from_xpath, args.author_from_csss),
+            (args.categories_from_xpath, args.categories_from_csss),
+        ):
+            if xpath or csss:
+                self._groups.append((xpath, csss))
+        self._parser = lxml.etree.HTMLPullParser(events=("end",))
+        self._parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup())
+        self._closed = set()
+        self._root = None
+        self._failed = False
+
+    def __call__(self, page_text, chunk_start):
+        if self._failed:
+            return False
+        self._parser.feed(page_text[chunk_start:])
+        for _, elem in self._parser.read_events():
+            self._closed.add(elem)
+            if self._root is None:
+                self._root = elem.getroottree().getroot()
+        if self._root is None:
+            return False
+        try:
+            return all(self._group_found(*group) for group in self._groups)
+        except (
+            cssselect.parser.SelectorSyntaxError,
+            lxml.etree.XPathEvalError,
+        ):
+            # The error will be reported when extracting the item.
+            self._failed = True
+            return False
+
+    def _group_found(self, xpath, csss):
+        results = []
+        if xpath:
+            results.extend(res for res in self._root.xpath(xpath) if res)
+        if not results and csss:
+            results.extend(self._root.cssselect(csss))
+        if not results:
+            return False
+        res = results[0]
+        if not isinstance(res, lxml.etree.ElementBase):
+            # Text or attribute values (as "smart strings") from XPath.
+            res = res.getparent() if hasattr(res, "getparent") else None
+        return res is None or res in self._closed
+
+
+def make_stop_condition(args):
+    """Make the stop condition for downloading pages followed according to
+    the options, or None if the entire page is required.
+    """
+    if not needs_document_tree(args):
+        return head_end_found
+    if args.partial_download and not (args.with_body or args.dedup_content):
+        return SelectorsFoundCheck(args)
+    return None
+
+
+def make_item_body(args, page_text, tree, in_place=False):
+    """Extract the item body from the document tree, as HTML.
+
+    The body is processed on a copy of the elements, unless in_place is
+    True; this saves memory but leaves the tree unusable for anything else.
+    """
     bodyhtml = None
     try:
-        lst = None
-        if args.body_xpath:
-            lst = tree.xpath(args.body_xpath)
-        if (not lst) and args.body_csss:
-            lst = tree.cssselect(args.body_csss)
-        if not args.body_xpath and not args.body_csss:
-            lst = tree.xpath("/html/body/*")
-        if lst:
-            if len(lst) > 1:
-                body = lxml.html.Element("div")
-                body.extend(lst)
-            else:
-                body = lst[0]
-            body = copy.deepcopy(body)
-            post_process_item_body(args, body)
-            cleaner = lxml.html.clean.Cleaner()
-            body = cleaner.clean_html(body)
-            if isinstance(body, str):
-                bodyhtml = body
-            else:
+        with stats.timed("body"):
+            lst = None
+            if args.body_xpath:
+                lst = tree.xpath(args.body_xpath)
+            if (not lst) and args.body_csss:
+                lst = tree.cssselect(args.body_csss)
+            if not args.body_xpath and not args.body_csss:
+                lst = tree.xpath("/html/body/*")
+            if lst:
+                if not in_place:
+                    lst = [copy.deepcopy(elem) for elem in lst]
+                if len(lst) > 1:
+                    body = lxml.html.Element("div")
+                    body.extend(lst)
+                else:
+                    body = lst[0]
+                    if body.getparent() is not None:
+                        # Detach it from the tree, as a copy would be.
+                        body.getparent().remove(body)
+                post_process_item_body(args, body)
+                # Cleaner.clean_html() would make yet another copy of the body.
+                cleaner = lxml.html.clean.Cleaner()
+                cleaner(body)
                 bodyhtml = lxml.html.tostring(
                     body, pretty_print=False, encoding="unicode"
                 )
@@ -161,11 +305,25 @@ def find_item_title(args, attr_parser, request, tree, anchor_text, base_attrs):
     return make_clean_title(args, title)
 
 
-def find_item_date(args, attr_parser, request, tree, anchor_text, orig_url):
+def find_item_date(
+    args, attr_parser, request, tree, anchor_text, orig_url, link_date=None
+):
     """Try to get a meaningful last modification date for an item.
     Only argument 'args' is required, everything else can be set to None and
     will be tried according to availability.
     """
+    return find_item_date_and_source(
+        args, attr_parser, request, tree, anchor_text, orig_url, link_date
+    )[0]
+
+
+def find_item_date_and_source(
+    args, attr_parser, request, tree, anchor_text, orig_url, link_date=None
+):
+    """Like find_item_date(), but return a tuple with the date and a string
+    telling where it was found ("xpath", "csss", "text", "url", "meta",
+    "link", or "Last-Modified"), or (None, None).
+    """
     date = None
     if not date and args.date_from_xpath and tree is not None:
         try:
@@ -176,7 +334,7 @@ def find_item_date(args, attr_parser, request, tree, anchor_text, orig_url):
                 )
                 if date:
                     logger.debug("Found date from XPath %s", date)
-                    break
+                    return date, "xpath"
         except lxml.etree.XPathEvalError:
             pass
     if not date and args.date_from_csss and tree is not None:
@@ -191,30 +349,38 @@ def find_item_date(args, attr_parser, request, tree, anchor_text, orig_url):
                 )
                 if date:
                     logger.debug("Found date from CSS Selector %s", date)
-                    break
+                    return date, "csss"
         except (cssselect.parser.SelectorSyntaxError, lxml.etree.XPathEvalError):
             logger.exception("When handling a CSS selector")
     if not date and args.date_from_text and anchor_text:
         date = utils.try_date_from_str(
             anchor_text, args.date_from_text, args.text_date_fmt
         )
+        if date:
+            return date, "text"
     if not date and args.date_from_url and orig_url:
         date = utils.try_date_from_str(orig_url, args.date_from_url, args.url_date_fmt)
+        if date:
+            return date, "url"
     if not date and attr_parser and attr_parser.changed:
-        date = attr_parser.changed
+        return attr_parser.changed, "meta"
+    if not date and link_date:
+        # From the sitemap or feed where the link was found.
+        return link_date, "link"
     if not date and request and ("Last-Modified" in request.headers):
         last_mod = request.headers["Last-Modified"]
         try:
-            date = dateutil.parser.parse(last_mod)
+            date = utils.parse_date(last_mod, "Last-Modified")
             logger.debug(
                 "No date was found but an HTTP header 'Last-Modified' was. "
                 "Assuming its value %s as the date %s",
                 last_mod,
                 date,
             )
+            return date, "Last-Modified"
         except dateutil.parser.ParserError:
             logger.exception('Invalid date in HTTP header "Last-modified"')
-    return date
+    return None, None
 
 
 def find_item_author(args, attr_parser, tree):
@@ -302,113 +468,411 @@ def find_item_categories(args, attr_parser, tree):
     return valid_categories
 
 
-def do_session_http_get(session, url, timeout=2, max_len_kb=0, encoding=None):
-    """Do a HTTP(S) GET request for the URL in the context of session,
-    subjected to the limits imposed for timeout (in seconds), max_len_kb
-    (in kilobytes) and using the given encoding to return the resulting page
-    as a *text* string.
+def is_followable_response(req, max_len_kb=0):
+    """Check the headers of a response to decide if its body is worth
+    downloading, i.e. if it is a HTML page not larger than max_len_kb
+    kilobytes. Missing headers are assumed to be good news.
+    """
+    content_type = req.headers.get("Content-Type")
+    if content_type:
+        mime_type = content_type.split(";", 1)[0].strip().lower()
+        if mime_type not in HTML_CONTENT_TYPES:
+            return False
+    content_length = req.headers.get("Content-Length")
+    if content_length and max_len_kb:
+        try:
+            if int(content_length) > 1024 * max_len_kb:
+                return False
+        except ValueError:
+            pass
+    return True
 
-    Returns the text and the request object. For exceptions, the text will be
-    None and more error information must be inferred from the request object.
+
+def do_session_http_head(session, url, timeout=2, deadline=None):
+    """Do a HTTP(S) HEAD request for the URL in the context of session,
+    following redirects. Returns the request object or None if the request
+    failed or the deadline was already reached.
     """
-    page_text = None
-    req = None
+    if utils.deadline_expired(deadline):
+        return None
+    if deadline is not None:
+        timeout = max(0.001, min(timeout, deadline - time.monotonic()))
     try:
-        logger.info("Following URL %s", url)
-        req = session.get(url, timeout=timeout, stream=True)
-        logger.debug("Request returned status code: %d", req.status_code)
-        logger.debug("Request headers: %s", req.request.headers)
+        logger.info("Checking URL %s", url)
+        req = session.head(url, timeout=timeout, allow_redirects=True)
+        logger.debug("HEAD request returned status code: %d", req.status_code)
         logger.debug("Response headers: %s", req.headers)
-        logger.debug("Cookies: %s", session.cookies)
-        if encoding:
-            req.encoding = encoding
-        chunk_size = 1024 * min(100, max_len_kb)
-        if req.status_code == 200:
-            page_text = ""
-            consumed_size = 0
-            for chunk in req.iter_content(chunk_size=chunk_size, decode_unicode=True):
-                if consumed_size >= 1024 * max_len_kb:
-                    break
-                consumed_size += len(chunk)
-                if type(chunk) == bytes:
-                    logger.warning("Unexpected binary return, trying to fix.")
-                    chunk = chunk.decode("utf-8")
-                page_text += chunk
+        return req
     except (
         urllib3.exceptions.ReadTimeoutError,
         requests.exceptions.Timeout,
+        requests.exceptions.ConnectionError,
     ):
-        logger.exception("When downloading %s", url)
-        # We should handle this somehow.
+        logger.exception("When checking %s", url)
+    return None
+
+
+def do_session_http_get(
+    session,
+    url,
+    timeout=2,
+    max_len_kb=0,
+    encoding=None,
+    deadline=None,
+    check_response=None,
+    stop_condition=None,
+    consume_chunk=None,
+    binary=False,
+):
+    """Do a HTTP(S) GET request for the URL in the context of session,
+    subjected to the limits imposed for timeout (in seconds), max_len_kb
+    (in kilobytes) and using the given encoding to return the resulting page
+    as a *text* string. Without an encoding, it is found by module charsets
+    from the page bytes and set in the request object.
+
+    If a deadline is given (as returned by utils.make_deadline), the request
+    is not started if it was already reached and the download is truncated
+    once it expires, so slow servers can not hold us for longer than that.
+
+    If check_response is given, it is called with the request object once
+    the response headers arrive and the body is not downloaded (i.e. text
+    is None) if it returns False.
+
+    If stop_condition is given, it is called for every chunk of text that
+    arrives with the text downloaded so far and the position where the new
+    chunk starts in it; the download stops once it returns True. This is
+    used for getting only the part of the page that is actually needed.
+
+    If consume_chunk is given, it is called for every chunk of text as it
+    arrives and the text is not kept, so the returned text is empty. This is
+    used for parsing pages while they are downloaded. If binary is True, it
+    is given the bytes received instead, without finding their encoding.
+
+    Returns the text and the request object. For exceptions, the text will be
+    None and more error information must be inferred from the request object.
+    """
+    start = time.monotonic()
+    with stats.timed("fetch", url=url) as span:
         page_text = None
-    finally:
-        if req:
-            req.close()
-    return page_text, req
+        req = None
+        if utils.deadline_expired(deadline):
+            logger.warning("Time limit reached, not downloading %s", url)
+            return page_text, req
+        if deadline is not None:
+            timeout = max(0.001, min(timeout, deadline - time.monotonic()))
+        try:
+            logger.info("Following URL %s", url)
+            req = session.get(url, timeout=timeout, stream=True)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Request returned status code: %d", req.status_code)
+                logger.debug("Request headers: %s", req.request.headers)
+                logger.debug("Response headers: %s", req.headers)
+                logger.debug("Cookies: %s", session.cookies)
+            if req.status_code == 200 and check_response and not check_response(req):
+                return page_text, req
+            chunk_size = 1024 * min(100, max_len_kb)
+            if deadline is not None:
+                # Reads block until the chunk is full, so use smaller ones to
+                # check the deadline often enough on slow-drip servers.
+                chunk_size = min(chunk_size, 1024)
+            if stop_condition:
+                # Smaller chunks, so we can stop closer to the required data.
+                chunk_size = min(chunk_size, 4096)
+            if req.status_code == 200:
+                page_text = ""
+                consumed_size = 0
+                decoder = charsets.StreamDecoder(
+                    req.url, req.headers.get("Content-Type"), encoding
+                )
+                try:
+                    for data in req.iter_content(chunk_size=chunk_size):
+                        if consumed_size >= 1024 * max_len_kb:
+                            break
+                        consumed_size += len(data)
+                        chunk = data if binary else decoder.decode(data)
+                        if consume_chunk:
+                            if chunk:
+                                consume_chunk(chunk)
+                        elif chunk:
+                            chunk_start = len(page_text)
+                            page_text += chunk
+                            if stop_condition and stop_condition(
+                                page_text, chunk_start
+                            ):
+                                logger.debug("Got the required data, stopping download")
+                                break
+                        if utils.deadline_expired(deadline):
+                            logger.warning("Time limit reached, truncating %s", url)
+                            break
+                except (
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                ):
+                    # The read timeout was shortened to fit the deadline; keep
+                    # what was received so far if it was the reason.
+                    if not utils.deadline_expired(deadline):
+                        raise
+                    logger.warning("Time limit reached, truncating %s", url)
+                chunk = None if binary else decoder.flush()
+                if chunk:
+                    if consume_chunk:
+                        consume_chunk(chunk)
+                    else:
+                        page_text += chunk
+                req.encoding = decoder.encoding
+        except (
+            urllib3.exceptions.ReadTimeoutError,
+            requests.exceptions.Timeout,
+        ):
+            logger.exception("When downloading %s", url)
+            # We should handle this somehow.
+            page_text = None
+        finally:
+            if req:
+                size = req.raw.tell()
+                stats.count("bytes", size)
+                req.close()
+                if span:
+                    span.set(status=req.status_code, bytes=size)
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info(
+                        "Downloaded %s (status %d, %d bytes, %.3fs)",
+                        url,
+                        req.status_code,
+                        size,
+                        time.monotonic() - start,
+                        extra={
+                            "event": "fetch",
+                            "url": url,
+                            "final_url": req.url,
+                            "status": req.status_code,
+                            "bytes": size,
+                            "duration": round(time.monotonic() - start, 6),
+                        },
+                    )
+        return page_text, req
 
 
-def make_feed_item_follow(session, url, used_urls, args, link_text, base_attrs):
+def fetch_item_page(session, link, used_urls, args, deadline=None, full_page=False):
+    """Download the page for a link that will be followed. Only the part
+    needed according to the options is downloaded, unless full_page is True.
+
+    Returns a Page record, an Item for links that are not worth following
+    (see option --skip-non-html) or None if the link must be ignored.
+    """
+    url = link.url
+    check_response = None
+    if args.skip_non_html or args.head_requests:
+        check_response = functools.partial(
+            is_followable_response, max_len_kb=args.max_page_length
+        )
+
+    if args.head_requests:
+        req = do_session_http_head(session, url, args.http_timeout, deadline)
+        # Servers may not support HEAD at all; just try a GET in this case.
+        if req is not None and req.status_code == 200 and not check_response(req):
+            return make_skipped_feed_item(req, link, used_urls, args)
+
     page_text, req = do_session_http_get(
-        session, url, args.http_timeout, args.max_page_length, args.encoding
+        session,
+        url,
+        args.http_timeout,
+        args.max_page_length,
+        args.encoding,
+        deadline,
+        check_response,
+        None if full_page else make_stop_condition(args),
     )
+    if page_text is None and req is not None and req.status_code == 200:
+        if check_response and not check_response(req):
+            return make_skipped_feed_item(req, link, used_urls, args)
     if not page_text:
         return None
     if req.url in used_urls:
         return None
 
     used_urls.add(req.url)
+    return records.Page(req.url, req.status_code, req.headers, page_text)
+
+
+def parse_item_page(args, page, with_tree=False):
+    """Parse the page downloaded for a link. Returns the attribute parser
+    and the document tree, which is None unless it is required by the
+    options (or by with_tree) and could be parsed.
+    """
     attr_parser = parsers.CollectAttributesParser()
-    description = ""
-    if req.status_code == 200:
-        attr_parser.feed(page_text)
-    else:
-        description += "Page returned status code %d<br/>" % req.status_code
+    if page.status_code == 200:
+        attr_parser.feed(page.text)
+    tree = None
+    if with_tree or needs_document_tree(args):
+        try:
+            tree = lxml.html.document_fromstring(page.text)
+        except lxml.etree.ParserError:
+            logger.exception(
+                "Failed to parse document, some information won't be available"
+            )
+    return attr_parser, tree
+
+
+def make_item_from_page(args, page, link, content_index=None):
+    """Extract a feed item from the page downloaded for a link.
+
+    This is the CPU-bound part of following links. It only takes and
+    returns picklable objects, so it may run in a worker process; in this
+    case, content_index is not available and duplicated contents must be
+    checked by the caller from the item fingerprints.
+    """
+    start = time.monotonic()
+    with stats.timed("parse", url=page.url) as span:
+        attr_parser, tree = parse_item_page(args, page)
+        # This is the only use of the tree, so the body may be processed in
+        # place, saving a copy.
+        item = make_item_from_parsed_page(
+            args, page, link, attr_parser, tree, content_index, in_place=True
+        )
+        if span:
+            span.set(emitted=item is not None)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(
+            "Made item for %s (%.3fs)%s",
+            page.url,
+            time.monotonic() - start,
+            "" if item else ", ignored",
+            extra={
+                "event": "item",
+                "url": page.url,
+                "title": item.title if item else None,
+                "emitted": item is not None,
+                "characters": len(page.text),
+                "duration": round(time.monotonic() - start, 6),
+            },
+        )
+    return item
+
+
+def make_item_in_worker(args, page, link, trace):
+    """Run make_item_from_page() in a worker process. Statistics and trace
+    spans (if trace is True) are collected separately for every page and
+    returned with the item, as the ones in the worker never reach the main
+    process; it must give them to merge_worker_result().
+    """
+    worker_stats = stats.begin(page.url)
+    tracer = tracing.begin("worker") if trace else None
+    try:
+        item = make_item_from_page(args, page, link)
+    finally:
+        stats.end()
+        tracing.end()
+    spans = (tracer.spans, tracer.root.span_id) if tracer else None
+    return item, worker_stats.export(), spans
+
+
+def merge_worker_result(result):
+    """Merge the statistics and spans returned by make_item_in_worker() and
+    return the item.
+    """
+    item, worker_stats, spans = result
+    stats.merge(*worker_stats)
+    tracer = tracing.current()
+    if tracer and spans:
+        tracer.adopt(*spans)
+    return item
+
+
+def make_item_from_parsed_page(
+    args,
+    page,
+    link,
+    attr_parser,
+    tree,
+    content_index=None,
+    in_place=False,
+    date_and_source=None,
+):
+    """Extract a feed item from a page already parsed by parse_item_page().
+    The tree is left untouched unless in_place is True. If the caller needs
+    to know where the date was found, it may give the result of
+    find_item_date_and_source() for the page as date_and_source.
+    """
+    link_text = link.text
     if attr_parser.description:
         description = attr_parser.description
     else:
         description = link_text
 
-    item_url = attr_parser.canonical or req.url
-    tree = None
-    try:
-        tree = lxml.html.document_fromstring(page_text)
-    except lxml.etree.ParserError:
-        logger.exception(
-            "Failed to parse document, some information won't be available"
+    item_url = attr_parser.canonical or page.url
+    title = find_item_title(args, attr_parser, page, tree, link_text, None)
+    if date_and_source is None:
+        date_and_source = find_item_date_and_source(
+            args, attr_parser, page, tree, link_text, item_url, link.date
         )
-
-    title = find_item_title(args, attr_parser, req, tree, link_text, base_attrs)
-    date = find_item_date(args, attr_parser, req, tree, link_text, item_url)
+    date = date_and_source[0]
     if args.require_dates and not date:
         # We need a date but the page have none. Skip this entry.
-        logger.info("Ignoring feed entry without date %s", url)
+        logger.info("Ignoring feed entry without date %s", link.url)
         return None
+    guid = page.url
+    fingerprints = None
+    if args.dedup_content:
+        fingerprints = make_item_fingerprints(args, attr_parser, tree, title, item_url)
+        if content_index is not None:
+            guid = content_index.resolve(fingerprints, guid)
+            fingerprints = None
+            if guid is None:
+                logger.info("Ignoring duplicated content in %s", page.url)
+                return None
     author = find_item_author(args, attr_parser, tree)
+    categories = find_item_categories(args, attr_parser, tree)
     if args.with_body and tree is not None:
-        bodyhtml = make_item_body(args, page_text, tree)
+        bodyhtml = make_item_body(args, page.text, tree, in_place)
         if bodyhtml:
             description = bodyhtml
-    categories = find_item_categories(args, attr_parser, tree)
     if date:
         # PyRSS2Gen ignores tzinfos and requires the date to be explicitly in UTC.
         date = datetime.datetime.fromtimestamp(date.timestamp(), datetime.timezone.utc)
-    return PyRSS2Gen.RSSItem(
+    return records.Item(
         title=title,
         link=item_url,
         author=author,
         description=description,
-        guid=PyRSS2Gen.Guid(req.url),
+        guid=guid,
         categories=categories,
-        pubDate=date,
+        date=date,
+        fingerprints=fingerprints,
     )
 
 
-def make_feed_item_nofollow(url, used_urls, args, link_text, base_attrs):
+def make_item_fingerprints(args, attr_parser, tree, title, item_url):
+    """Return the fingerprints identifying the contents of an item, taken
+    before its body is processed. Only the text of the body is used, as
+    the description may be the same for the entire site.
+    """
+    text = None
+    if tree is not None:
+        body = tree.find("body")
+        if body is not None:
+            text = body.text_content()
+    canonical = item_url if attr_parser.canonical else None
+    return dedup.content_fingerprints(canonical, title, text)
+
+
+def make_feed_item_follow(
+    session, link, used_urls, args, base_attrs, deadline=None, content_index=None
+):
+    page = fetch_item_page(session, link, used_urls, args, deadline)
+    if not isinstance(page, records.Page):
+        return page
+    return make_item_from_page(args, page, link, content_index)
+
+
+def make_feed_item_nofollow(link, used_urls, args, base_attrs):
+    url = link.url
+    link_text = link.text
     if url in used_urls:
         return None
     used_urls.add(url)
     clean_title = make_clean_title(args, link_text)
-    date = find_item_date(args, None, None, None, link_text, url)
+    date = find_item_date(args, None, None, None, link_text, url, link.date)
     # We need a date but the page have none. Skip this entry.
     if args.require_dates and not date:
         logger.info("Ignoring feed entry without date %s", url)
@@ -417,23 +881,120 @@ def make_feed_item_nofollow(url, used_urls, args, link_text, base_attrs):
     if date:
         # PyRSS2Gen ignores tzinfos and requires the date to be explicitly in UTC.
         date = datetime.datetime.fromtimestamp(date.timestamp(), datetime.timezone.utc)
-    return PyRSS2Gen.RSSItem(
+    return records.Item(
         title=clean_title,
         link=url,
         description=link_text,
-        guid=PyRSS2Gen.Guid(url),
-        pubDate=date,
+        guid=url,
+        date=date,
     )
 
 
-def write_feed(rss, args):
-    if args.output:
-        logger.debug("Writing feed to %s", args.output)
-        with open(args.output, "w", encoding="utf-8") as fp:
-            rss.write_xml(fp, encoding="utf-8")
-    else:
+def make_skipped_feed_item(req, link, used_urls, args):
+    """Make a link-only feed item for a followed URL that was not downloaded
+    because it does not look like a HTML page.
+    """
+    logger.info(
+        "Not following %s (Content-Type: %s, Content-Length: %s)",
+        req.url,
+        req.headers.get("Content-Type"),
+        req.headers.get("Content-Length"),
+    )
+    item = make_feed_item_nofollow(link, used_urls, args, None)
+    used_urls.add(req.url)
+    return item
+
+
+def render_feed(rss):
+    fp = io.StringIO()
+    rss.write_xml(fp, encoding="utf-8")
+    return fp.getvalue().encode("utf-8")
+
+
+def read_previous_feed(filename):
+    """Return the contents of a feed file written by a previous run and its
+    lastBuildDate, as text; (None, None) if there is no such file.
+    """
+    try:
+        with open(filename, "rb") as fp:
+            data = fp.read()
+    except FileNotFoundError:
+        return None, None
+    try:
+        build_date = lxml.etree.fromstring(data).findtext("channel/lastBuildDate")
+    except lxml.etree.XMLSyntaxError:
+        build_date = None
+    return data, build_date
+
+
+def compress_feed(data, method):
+    if method == "gz":
+        # A fixed mtime, so the same feed always gives the same file.
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    return brotli.compress(data)
+
+
+def make_etag(data):
+    return '"%s"' % hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def write_feed_companions(args, data, missing_only=False):
+    """Write the pre-compressed versions and the ETag of the feed file, as
+    requested by the options. They must be written after the feed file, so
+    the ETag is never seen before the feed it describes. If missing_only is
+    True, existing files are assumed to be up to date and left alone.
+    """
+    companions = []
+    for method in args.precompress or []:
+        if method == "br" and brotli is None:
+            logger.warning("Module brotli is not installed, not writing .br")
+            continue
+        companions.append((args.output + "." + method, method))
+    if args.write_etag:
+        # Written last, as it describes all the files.
+        companions.append((args.output + ".etag", None))
+    for filename, method in companions:
+        if missing_only and os.path.exists(filename):
+            continue
+        if method:
+            content = compress_feed(data, method)
+        else:
+            content = (make_etag(data) + "\n").encode("ascii")
+        logger.debug("Writing %s", filename)
+        utils.write_file_atomically(filename, content)
+
+
+def write_feed(rss, args, keep_existing=False):
+    """Write the feed to the output file or stdout. If keep_existing is True
+    (i.e. the feed is incomplete), an existing output file is not replaced.
+    """
+    if not args.output:
         logger.debug("Writing feed to stdout")
         rss.write_xml(sys.stdout, encoding="utf-8")
+        return
+
+    if keep_existing and os.path.exists(args.output):
+        logger.warning("Feed is incomplete, keeping the previous %s", args.output)
+        return
+
+    if args.only_if_changed:
+        # Render the new feed with the date from the previous one; if that
+        # gives the same file, nothing has really changed.
+        old_data, old_build_date = read_previous_feed(args.output)
+        if old_build_date:
+            build_date = rss.lastBuildDate
+            rss.lastBuildDate = old_build_date
+            if render_feed(rss) == old_data:
+                logger.info("Feed not changed, keeping %s", args.output)
+                stats.count("unchanged_feeds")
+                write_feed_companions(args, old_data, missing_only=True)
+                return
+            rss.lastBuildDate = build_date
+
+    data = render_feed(rss)
+    logger.debug("Writing feed to %s", args.output)
+    utils.write_file_atomically(args.output, data)
+    write_feed_companions(args, data)
 
 
 def make_exception_feed(exc, args=None):
@@ -472,43 +1033,411 @@ def make_exception_feed(exc, args=None):
     write_feed(rss, args)
 
 
-def test_links(link_grabber, args):
+def test_links(link_grabber, args, session=None):
     args.no_exception_feed = True
+    followed = []
+    if session is not None and args.test_follow:
+        followed = select_links(args, link_grabber.links)[: args.test_follow]
+    used_urls = set()
     if link_grabber.limit_reached:
         print("# Limit of %d links was reached." % (link_grabber.max_items))
-    for itm in link_grabber.links:
-        print("- " + itm[0])
-        if itm[1] and itm[1] != "":
-            print("    text: " + itm[1])
+    for link in link_grabber.links:
+        print("- " + link.url)
+        if link.text and link.text != "":
+            print("    text: " + link.text)
         if args.date_from_url:
             date = utils.try_date_from_str(
-                itm[0], args.date_from_url, args.url_date_fmt
+                link.url, args.date_from_url, args.url_date_fmt
             )
             if date:
                 print("    url-date:  " + str(date))
-        if itm[1] and args.date_from_text:
+        if link.text and args.date_from_text:
             date = utils.try_date_from_str(
-                itm[1], args.date_from_text, args.text_date_fmt
+                link.text, args.date_from_text, args.text_date_fmt
             )
             if date:
                 print("    text-date: " + str(date))
+        if link in followed:
+            test_item(session, link, used_urls, args)
         print("")
 
 
-def get_start_page(args, session, base_attrs, link_grabber, base_url):
-    logger.info("Downloading start URL %s", base_url)
-    page_content, req = do_session_http_get(
-        session, base_url, args.http_timeout, args.max_first_page_length, args.encoding
+def test_item(session, link, used_urls, args):
+    """Follow a link and print the information extracted for its item."""
+    start = time.monotonic()
+    page = fetch_item_page(session, link, used_urls, args)
+    fetch_time = time.monotonic() - start
+    if not isinstance(page, records.Page):
+        print(
+            "    item: not followed (see log)" if page is None else "    item: skipped"
+        )
+        return
+    start = time.monotonic()
+    attr_parser, tree = parse_item_page(args, page)
+    date_and_source = find_item_date_and_source(
+        args,
+        attr_parser,
+        page,
+        tree,
+        link.text,
+        attr_parser.canonical or page.url,
+        link.date,
+    )
+    item = make_item_from_parsed_page(
+        args,
+        page,
+        link,
+        attr_parser,
+        tree,
+        in_place=True,
+        date_and_source=date_and_source,
+    )
+    date_source = date_and_source[1]
+    parse_time = time.monotonic() - start
+    if item is None:
+        print("    item: ignored, no date")
+    else:
+        print("    item-title: " + item.title)
+        if item.link != link.url:
+            print("    item-link: " + item.link)
+        if date_source:
+            print("    item-date: %s (from %s)" % (item.date, date_source))
+        else:
+            print("    item-date: not found")
+        if item.author:
+            print("    item-author: " + item.author)
+        if item.categories:
+            print("    item-categories: " + ", ".join(item.categories))
+        print("    item-description: %d characters" % len(item.description or ""))
+    print(
+        "    item-time: fetch %.1f ms, parse %.1f ms, %d kB"
+        % (1000 * fetch_time, 1000 * parse_time, len(page.text) // 1024)
     )
 
+
+class StartPageStream:
+    """Parses a start page with its own link and attribute parsers while it
+    is downloaded, so the page is never held in memory as a whole.
+
+    Links are collected into 'links' (a CollectLinksParser) to be merged
+    in order by the caller; 'head' keeps the text up to the end of <head>,
+    which is all needed for the feed attributes. If next pages are looked
+    for, the document is also built as a tree by an lxml pull parser; the
+    tree must be closed by the same thread that fed it, as libxml2 keeps
+    per-thread state, so fetch_start_page() does it before returning.
+    """
+
+    def __init__(self, args, url_normalizer=None):
+        self.req = None
+        self.attrs = parsers.CollectAttributesParser()
+        self.links = parsers.CollectLinksParser(
+            args.link_pattern,
+            args.ignore_pattern,
+            args.max_links,
+            None,
+            url_normalizer or utils.UrlNormalizer(args.qs_remove_param),
+        )
+        self.head = ""
+        self.tree = None
+        self.tree_parser = None
+        if args.next_page_xpath or args.next_page_csss:
+            self.tree_parser = lxml.html.HTMLParser()
+
+    def start(self, req):
+        """Called by do_session_http_get() once the response arrives."""
+        self.req = req
+        self.links.base_url = req.url
+        self.links.source_url = req.url
+        return True
+
+    def __call__(self, chunk):
+        if not self.attrs.head_done:
+            self.head += chunk
+            self.attrs.feed(chunk)
+            if self.attrs.base and self.links.base_url != self.attrs.base:
+                # Links after <base> are relative to it.
+                self.links.base_url = self.attrs.base
+        self.links.feed(chunk)
+        if self.tree_parser is not None:
+            self.tree_parser.feed(chunk)
+
+    def close_tree(self):
+        """Finish the document tree and keep its root in 'tree'."""
+        if self.tree_parser is None:
+            return
+        try:
+            self.tree = self.tree_parser.close()
+        except lxml.etree.XMLSyntaxError:
+            logger.exception("Failed to parse start page, can not find next pages")
+        self.tree_parser = None
+
+
+def fetch_start_page(args, session, url, deadline=None, url_normalizer=None):
+    logger.info("Downloading start URL %s", url)
+    stream = StartPageStream(args, url_normalizer)
+    _, req = do_session_http_get(
+        session,
+        url,
+        args.http_timeout,
+        args.max_first_page_length,
+        args.encoding,
+        deadline,
+        check_response=stream.start,
+        consume_chunk=stream,
+    )
+    if stream.req is None:
+        stream.req = req
+    stream.close_tree()
+    return stream
+
+
+def find_next_pages(args, tree, base_url):
+    """Return the URLs of the next index pages linked from a start page, as
+    given by options --next-page-xpath and --next-page-csss.
+    """
+    if tree is None:
+        return []
+
+    results = []
+    if args.next_page_xpath:
+        try:
+            results.extend(res for res in tree.xpath(args.next_page_xpath) if res)
+        except lxml.etree.XPathEvalError:
+            logger.exception("When trying to find next page from XPath")
+    if not results and args.next_page_csss:
+        try:
+            results.extend(tree.cssselect(args.next_page_csss))
+        except (cssselect.parser.SelectorSyntaxError, lxml.etree.XPathEvalError):
+            logger.exception("When trying to find next page from a CSS selector")
+
+    urls = []
+    for res in results:
+        # Elements give their "href"; XPath may also return it directly.
+        href = res.get("href") if isinstance(res, lxml.etree.ElementBase) else res
+        if href and str(href).strip():
+            href = str(href).strip().split("#", 2)[0]
+            urls.append(requests.compat.urljoin(base_url, href))
+    return urls
+
+
+def parse_start_page(args, base_attrs, link_grabber, stream):
+    """Collect links and feed attributes from a start page parsed by a
+    StartPageStream; return the URLs of the next pages found in it.
+    """
     base_attrs.reset_parser()
-    base_attrs.feed(page_content)
+    base_attrs.feed(stream.head)
+
+    link_grabber.merge(stream.links)
 
-    link_grabber.reset_parser()
-    link_grabber.base_url = base_attrs.base or req.url
-    link_grabber.feed(page_content)
+    return find_next_pages(args, stream.tree, stream.links.base_url)
 
-    return req
+
+def get_start_pages(args, session, base_attrs, link_grabber, deadline=None):
+    """Download and parse all start pages, including the next pages found
+    in them up to --max-next-pages levels deep.
+
+    The pages at every level are known beforehand, so up to --index-workers
+    of them are downloaded concurrently; they are still parsed in order, so
+    links are collected as if they were downloaded one after the other, and
+    no more downloads are started once the links limit is reached. Returns
+    the response for the first page downloaded, or None.
+    """
+    first_req = None
+    seen_urls = set()
+    level_urls = []
+    for url in args.urls:
+        if url not in seen_urls:
+            seen_urls.add(url)
+            level_urls.append(url)
+
+    with concurrent.futures.ThreadPoolExecutor(args.index_workers) as executor:
+        for depth in range(args.max_next_pages + 1):
+            urls = iter(level_urls)
+            # Downloads started and not parsed yet, in order.
+            pending = collections.deque()
+
+            def start_downloads():
+                while len(pending) < args.index_workers:
+                    if link_grabber.limit_reached:
+                        return
+                    url = next(urls, None)
+                    if url is None:
+                        return
+                    if utils.deadline_expired(deadline):
+                        logger.warning("Time limit reached, skipping start URL %s", url)
+                        continue
+                    future = executor.submit(
+                        fetch_start_page,
+                        args,
+                        session,
+                        url,
+                        deadline,
+                        link_grabber.url_normalizer,
+                    )
+                    pending.append((url, future))
+
+            start_downloads()
+            next_urls = []
+            while pending:
+                url, future = pending.popleft()
+                try:
+                    stream = future.result()
+                except Exception:
+                    if depth == 0:
+                        raise
+                    # A broken "next" page should not lose everything else.
+                    logger.exception("When downloading next page %s", url)
+                    start_downloads()
+                    continue
+                if stream.req is not None:
+                    seen_urls.add(stream.req.url)
+                    if first_req is None:
+                        first_req = stream.req
+                    for next_url in parse_start_page(
+                        args, base_attrs, link_grabber, stream
+                    ):
+                        if next_url not in seen_urls:
+                            logger.info("New next page added: %s", next_url)
+                            seen_urls.add(next_url)
+                            next_urls.append(next_url)
+                if link_grabber.limit_reached:
+                    for _, other in pending:
+                        other.cancel()
+                    return first_req
+                start_downloads()
+            level_urls = next_urls
+            if not level_urls:
+                break
+
+    return first_req
+
+
+def read_link_source(args, session, url, base_attrs, deadline=None):
+    """Download a sitemap or feed (or a HTML page announcing feeds, for the
+    "feed" link source) and parse it while it arrives.
+
+    Returns the parsed linksources.SourceDocument, or None if the URL could
+    not be downloaded, and the request object (None if there was no
+    response at all).
+    """
+    max_bytes = 1024 * args.max_first_page_length
+    stream = linksources.SourceStream(linksources.SourceDocument(), max_bytes)
+
+    def check_response(req):
+        content_type = req.headers.get("Content-Type", "").split(";")[0].strip()
+        # Not a feed, but it may announce one; also the page gives the
+        # title and description for our feed.
+        stream.keep_data = content_type.lower() in HTML_CONTENT_TYPES
+        return True
+
+    logger.info("Downloading start URL %s", url)
+    try:
+        text, req = do_session_http_get(
+            session,
+            url,
+            args.http_timeout,
+            args.max_first_page_length,
+            None,
+            deadline,
+            check_response=check_response,
+            consume_chunk=stream,
+            binary=True,
+        )
+    except requests.exceptions.ConnectionError:
+        logger.exception("When downloading %s", url)
+        return None, None
+    if text is None:
+        if req is not None and req.status_code != 200:
+            logger.warning("%s returned status code %d", url, req.status_code)
+        return None, req
+    doc = stream.close(utils.deadline_expired(deadline) or stream.received >= max_bytes)
+    if stream.keep_data:
+        encoding, _ = charsets.resolve_encoding(
+            req.url, req.headers.get("Content-Type"), stream.data, True, args.encoding
+        )
+        base_attrs.reset_parser()
+        base_attrs.feed(stream.data.decode(encoding, errors="replace"))
+    return doc, req
+
+
+def get_link_source_pages(args, session, base_attrs, link_grabber, deadline=None):
+    """Collect links from sitemaps or feeds given as start URLs, instead of
+    from HTML pages.
+
+    Sitemap indexes are followed, newest sitemaps first and skipping the
+    ones older than --max-link-age. For the "feed" link source, HTML pages
+    are searched for the feeds they announce. Links from every document
+    are added newest first, so --max-links keeps the most recent ones.
+    Returns the response for the first document downloaded, or None.
+    """
+    min_date = None
+    if args.max_link_age is not None:
+        min_date = time.time() - args.max_link_age * 86400
+
+    first_req = None
+    pending = list(dict.fromkeys(args.urls))
+    seen_urls = set(pending)
+    while pending and not link_grabber.limit_reached:
+        url = pending.pop(0)
+        if utils.deadline_expired(deadline):
+            logger.warning("Time limit reached, skipping start URL %s", url)
+            break
+        doc, req = read_link_source(args, session, url, base_attrs, deadline)
+        if doc is None:
+            continue
+        seen_urls.add(req.url)
+        if first_req is None:
+            first_req = req
+
+        if doc.kind is None and args.link_source == "feed":
+            feeds = [
+                requests.compat.urljoin(base_attrs.base or req.url, href)
+                for href in base_attrs.alternate_feeds
+            ]
+            # Only the first feed, others usually are for comments, etc.
+            if feeds and feeds[0] not in seen_urls:
+                logger.info("Using feed %s announced by %s", feeds[0], req.url)
+                seen_urls.add(feeds[0])
+                pending.insert(0, feeds[0])
+            elif not feeds:
+                logger.warning("No feeds found in %s", req.url)
+            continue
+        if doc.kind is None:
+            logger.warning("%s is not a sitemap or feed", req.url)
+            continue
+
+        if doc.title and not base_attrs.title:
+            base_attrs.title = doc.title
+
+        sitemaps = sorted(doc.sitemaps, key=link_source_sort_key)
+        for sitemap_url, date in sitemaps:
+            sitemap_url = requests.compat.urljoin(req.url, sitemap_url)
+            if sitemap_url in seen_urls:
+                continue
+            if min_date is not None and date and date.timestamp() < min_date:
+                logger.info("Ignoring old sitemap %s (%s)", sitemap_url, date)
+                continue
+            seen_urls.add(sitemap_url)
+            pending.append(sitemap_url)
+
+        link_grabber.base_url = req.url
+        link_grabber.source_url = req.url
+        for link_url, text, date in sorted(doc.links, key=link_source_sort_key):
+            if min_date is not None and date and date.timestamp() < min_date:
+                continue
+            link_grabber.add_link(link_url, text, date)
+            if link_grabber.limit_reached:
+                break
+
+    return first_req
+
+
+def link_source_sort_key(entry):
+    """Sort key for entries from link sources, newest first and keeping the
+    ones without dates at the end, in their original order.
+    """
+    date = entry[-1]
+    return -date.timestamp() if date else math.inf
 
 
 def make_accept_language_header(args):
@@ -579,12 +1508,83 @@ class ControlledCookiePolicy(http.cookiejar.DefaultCookiePolicy):
         return http.cookiejar.DefaultCookiePolicy.set_ok(self, cookie, request)
 
 
+def make_file_cookie_jar(filename):
+    """Make a cookie jar for reading and writing cookies to the given file.
+    Files in the LWP format (as written by libwww-perl) are detected, but
+    new files are always written in the Mozilla/Netscape format.
+    """
+    try:
+        with open(filename, encoding="utf-8") as fp:
+            if fp.readline().startswith("#LWP-Cookies"):
+                return http.cookiejar.LWPCookieJar(filename)
+    except OSError:
+        pass
+    return http.cookiejar.MozillaCookieJar(filename)
+
+
+def load_file_cookie_jar(filename):
+    """Load cookies from the given file, if it exists."""
+    jar = make_file_cookie_jar(filename)
+    try:
+        # Session cookies are kept too: every run is the same "browser
+        # session" as far as we are concerned.
+        jar.load(ignore_discard=True)
+    except FileNotFoundError:
+        logger.info("Cookie jar %s does not exist yet", filename)
+    except (http.cookiejar.LoadError, OSError):
+        logger.exception("Failed to load cookies from %s", filename)
+    return jar
+
+
+def load_cookies_for_session(session, filename):
+    """Add the cookies from the given file to the session. Returns the set
+    of keys of the cookies loaded, used when saving them back.
+    """
+    with utils.file_lock(filename):
+        jar = load_file_cookie_jar(filename)
+    loaded_keys = set()
+    for cookie in jar:
+        session.cookies.set_cookie(cookie)
+        loaded_keys.add((cookie.domain, cookie.path, cookie.name))
+    logger.info("Loaded %d cookies from %s", len(loaded_keys), filename)
+    return loaded_keys
+
+
+def save_cookies_from_session(session, filename, loaded_keys):
+    """Save the session cookies to the given file. Cookies added to the file
+    by other processes since it was loaded (i.e. not in set loaded_keys) are
+    kept, so concurrent runs sharing the same file do not lose cookies.
+    """
+    with utils.file_lock(filename):
+        jar = load_file_cookie_jar(filename)
+        for cookie in list(jar):
+            if (cookie.domain, cookie.path, cookie.name) in loaded_keys:
+                jar.clear(cookie.domain, cookie.path, cookie.name)
+        for cookie in session.cookies:
+            # Cookies from option --cookie have no domain and are given
+            # again in every run, so they are not worth saving.
+            if cookie.domain:
+                jar.set_cookie(cookie)
+        try:
+            with utils.replacing_file(filename) as tmp_filename:
+                jar.save(tmp_filename, ignore_discard=True)
+        except OSError:
+            logger.exception("Failed to save cookies to %s", filename)
+    logger.info("Saved %d cookies to %s", len(jar), filename)
+
+
 def set_cookie_options_for_session(session, args):
-    """Set the cookie options for the session."""
+    """Set the cookie options for the session. Returns the set of keys of
+    the cookies loaded from the cookie jar file, if any.
+    """
 
     policy = ControlledCookiePolicy()
     session.cookies = requests.cookies.RequestsCookieJar(policy=policy)
 
+    loaded_keys = set()
+    if args.cookie_jar:
+        loaded_keys = load_cookies_for_session(session, args.cookie_jar)
+
     if args.cookie:
         policy.read_only = False
         for cookie_spec in args.cookie:
@@ -594,68 +1594,342 @@ def set_cookie_options_for_session(session, args):
                 session.cookies[key] = value
 
     policy.read_only = bool(args.no_cookies)
+    return loaded_keys
+
+
+def find_link_date(args, link):
+    """Find the date for a link from its text or URL, as find_item_date()
+    would do, but without following it.
+    """
+    date = link.date
+    if not date and args.date_from_text and link.text:
+        date = utils.try_date_from_str(
+            link.text, args.date_from_text, args.text_date_fmt
+        )
+    if not date and args.date_from_url:
+        date = utils.try_date_from_str(link.url, args.date_from_url, args.url_date_fmt)
+    return date
+
+
+def select_links(args, links):
+    """Filter and sort the collected links by the dates found from their
+    text or URL, according to the options, before following any of them.
+    """
+    if args.max_link_age is not None or args.sort_links:
+        for link in links:
+            link.date = find_link_date(args, link)
+
+    if args.max_link_age is not None:
+        min_timestamp = time.time() - args.max_link_age * 86400
+        selected = []
+        for link in links:
+            if link.date and link.date.timestamp() < min_timestamp:
+                logger.info("Ignoring old link %s (%s)", link.url, link.date)
+            else:
+                selected.append(link)
+        links = selected
+
+    if args.sort_links:
+        # Newest first; links without a date go last, in their original order.
+        links = sorted(
+            links, key=lambda link: -link.date.timestamp() if link.date else math.inf
+        )
+
+    if args.max_follow is not None:
+        links = links[: args.max_follow]
+    return links
+
+
+def warn_deadline_reached(items):
+    logger.warning(
+        "Time limit reached, writing feed with the %d items found so far",
+        len(items),
+    )
+
+
+class MemoryBudget:
+    """The memory used by a feed, against the limit from --memory-budget.
 
+    Usage is measured as the growth of the resident set size since the feed
+    started, so memory kept from previous feeds in a batch is not counted.
+    Going over the limit only throttles the pages in flight; the feed is
+    truncated (and marked so in 'truncated') only if the limit is still
+    exceeded with no pages in flight.
+    """
 
-def make_feed(args):
-    session = requests.Session()
+    def __init__(self, args):
+        self.limit_kb = args.memory_budget * 1024 if args.memory_budget else None
+        self.start_kb = None
+        self.truncated = False
+        if self.limit_kb is not None:
+            self.start_kb = utils.get_memory_usage()
+            if self.start_kb is None:
+                logger.warning("Can not measure memory usage, ignoring budget")
+                self.limit_kb = None
+
+    def used(self):
+        """Memory used by the feed so far, in kilobytes."""
+        return max(0, utils.get_memory_usage() - self.start_kb)
+
+    def exceeded(self):
+        return self.limit_kb is not None and self.used() > self.limit_kb
+
+    def exhausted(self, items):
+        """Check if the budget is still exceeded with nothing in flight,
+        in which case no more links should be followed.
+        """
+        if not self.exceeded():
+            return False
+        # Unreachable trees from lxml are only freed by the collector.
+        gc.collect()
+        if not self.exceeded():
+            return False
+        logger.warning(
+            "Memory budget reached (%d kB used), writing feed with the %d items "
+            "found so far",
+            self.used(),
+            len(items),
+        )
+        stats.count("budget_truncated_feeds")
+        self.truncated = True
+        return True
+
+
+def make_items(
+    session,
+    links,
+    used_urls,
+    args,
+    base_attrs,
+    deadline=None,
+    content_index=None,
+    budget=None,
+):
+    """Make the feed items for the links, following them if requested.
+    Pages are followed one at a time, so only the memory budget (a
+    MemoryBudget) being exhausted stops this early.
+    """
+    items = []
+    for link in links:
+        if args.follow:
+            if utils.deadline_expired(deadline):
+                warn_deadline_reached(items)
+                break
+            if budget and budget.exhausted(items):
+                break
+            item_deadline = utils.earliest_deadline(
+                deadline, utils.make_deadline(args.item_budget)
+            )
+            ret_item = make_feed_item_follow(
+                session,
+                link,
+                used_urls,
+                args,
+                base_attrs,
+                item_deadline,
+                content_index,
+            )
+        else:
+            ret_item = make_feed_item_nofollow(link, used_urls, args, base_attrs)
+        if ret_item:
+            items.append(ret_item)
+    return items
+
+
+def make_items_with_workers(
+    session,
+    links,
+    used_urls,
+    args,
+    base_attrs,
+    deadline,
+    content_index=None,
+    budget=None,
+):
+    """Make the feed items for the links to follow, like make_items(), but
+    using a pool of worker processes for parsing the pages, so downloading
+    and parsing happen in parallel and parsing uses all available CPUs.
+    """
+    results = []
+    # Pages downloaded but not parsed yet. These are limited, or a slow CPU
+    # would make them pile up in memory while downloads go on; while over
+    # the memory budget, no more pages are sent until the workers are done
+    # with the ones they have.
+    in_flight = set()
+    max_in_flight = 2 * args.cpu_workers
+
+    def wait_for_workers():
+        nonlocal in_flight
+        _, in_flight = concurrent.futures.wait(
+            in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=args.cpu_workers, initializer=set_log_level, initargs=(args,)
+    ) as executor:
+        for link in links:
+            if utils.deadline_expired(deadline):
+                warn_deadline_reached(results)
+                break
+            if budget:
+                while in_flight and budget.exceeded():
+                    wait_for_workers()
+                if budget.exhausted(results):
+                    break
+            item_deadline = utils.earliest_deadline(
+                deadline, utils.make_deadline(args.item_budget)
+            )
+            page = fetch_item_page(session, link, used_urls, args, item_deadline)
+            if isinstance(page, records.Page):
+                while len(in_flight) >= max_in_flight:
+                    wait_for_workers()
+                future = executor.submit(
+                    make_item_in_worker,
+                    args,
+                    page,
+                    link,
+                    tracing.current() is not None,
+                )
+                in_flight.add(future)
+                results.append(future)
+            elif page:
+                results.append(page)
+
+        # Keep the items in the same order as the links.
+        items = []
+        for res in results:
+            if isinstance(res, concurrent.futures.Future):
+                item = merge_worker_result(res.result())
+            else:
+                item = res
+            if item and item.fingerprints is not None and content_index is not None:
+                item.guid = content_index.resolve(item.fingerprints, item.guid)
+                if item.guid is None:
+                    logger.info("Ignoring duplicated content in %s", item.link)
+                    continue
+            if item:
+                items.append(item)
+    return items
+
+
+def make_session(args, transport=None):
+    """Make the HTTP session for a feed. Returns it and the keys of the
+    cookies loaded into it, as from set_cookie_options_for_session().
+    """
+    if transport:
+        max_body_kb = max(args.max_page_length, args.max_first_page_length)
+        session = transport.make_session(max_body_kb)
+    else:
+        session = requests.Session()
     session.headers = make_default_http_headers(args)
-    set_cookie_options_for_session(session, args)
+    loaded_cookie_keys = set_cookie_options_for_session(session, args)
+    return session, loaded_cookie_keys
 
+
+def collect_links(args, session, deadline=None):
+    """Collect the links from the start URLs. Returns the attributes parser
+    for the feed and the links parser with the collected links.
+    """
     base_attrs = parsers.CollectAttributesParser()
     link_grabber = parsers.CollectLinksParser(
-        args.link_pattern, args.ignore_pattern, args.max_links, None
+        args.link_pattern,
+        args.ignore_pattern,
+        args.max_links,
+        None,
+        utils.UrlNormalizer(args.qs_remove_param),
     )
-    link_grabber.qs_cleanup_rx_list = args.qs_remove_param
 
-    for curr_url in args.urls:
-        req = get_start_page(args, session, base_attrs, link_grabber, curr_url)
-        if link_grabber.limit_reached:
-            break
-        if not "Referer" in session.headers:
-            session.headers["Referer"] = req.url
+    if args.link_source == "html":
+        req = get_start_pages(args, session, base_attrs, link_grabber, deadline)
+    else:
+        req = get_link_source_pages(args, session, base_attrs, link_grabber, deadline)
+    stats.count("url_cache_hits", link_grabber.url_normalizer.hits)
+    stats.count("url_cache_misses", link_grabber.url_normalizer.misses)
+    if req is not None and not "Referer" in session.headers:
+        session.headers["Referer"] = req.url
 
     # Handle fetch metadata headers according to
     # https://w3c.github.io/webappsec-fetch-metadata/
     if "Sec-Fetch-Site" in session.headers:
         session.headers["Sec-Fetch-Site"] = "same-origin"
 
-    if args.test:
-        test_links(link_grabber, args)
-        return
+    return base_attrs, link_grabber
 
-    # URLs that where already processed (considering redirects).
-    used_urls = set()
-    base_links = link_grabber.links
 
-    rss_items = []
-    for itm in base_links:
-        if args.follow:
-            ret_item = make_feed_item_follow(
-                session, itm[0], used_urls, args, itm[1], base_attrs
+def make_feed(args, transport=None):
+    # Absolute time limit for the entire run; once reached, no more pages
+    # are downloaded and the feed is written with whatever we have.
+    deadline = utils.make_deadline(args.deadline)
+    budget = MemoryBudget(args)
+
+    session, loaded_cookie_keys = make_session(args, transport)
+    try:
+        with stats.timed("start_pages"):
+            base_attrs, link_grabber = collect_links(args, session, deadline)
+
+        if args.test:
+            test_links(link_grabber, args, session)
+            return
+
+        # URLs that where already processed (considering redirects).
+        used_urls = set()
+        base_links = select_links(args, link_grabber.links)
+
+        content_index = None
+        if args.dedup_content:
+            content_index = dedup.ContentIndex(args.dedup_index)
+
+        if args.follow and args.cpu_workers > 1:
+            items = make_items_with_workers(
+                session,
+                base_links,
+                used_urls,
+                args,
+                base_attrs,
+                deadline,
+                content_index,
+                budget,
             )
         else:
-            ret_item = make_feed_item_nofollow(
-                itm[0], used_urls, args, itm[1], base_attrs
+            items = make_items(
+                session,
+                base_links,
+                used_urls,
+                args,
+                base_attrs,
+                deadline,
+                content_index,
+                budget,
             )
-        if ret_item:
-            rss_items.append(ret_item)
-
-    title = base_attrs.title or ", ".join(args.urls)
-    title = title[: args.max_title_length]
-
-    rss = PyRSS2Gen.RSS2(
-        title=args.title or title,
-        link=args.urls[0],
-        description=base_attrs.description
-        or base_attrs.title
-        or base_attrs.canonical
-        or ", ".join(args.urls),
-        # PyRSS2Gen ignores tzinfos and requires the date to be explicitly in UTC.
-        lastBuildDate=datetime.datetime.now(datetime.timezone.utc),
-        language=base_attrs.language,
-        items=rss_items,
-    )
-    write_feed(rss, args)
+        rss_items = [item.to_rss_item() for item in items]
+        stats.count("links", len(link_grabber.links))
+        stats.count("items", len(items))
+        stats.count("items_skipped", len(base_links) - len(items))
+
+        if content_index is not None:
+            content_index.save()
+
+        title = base_attrs.title or ", ".join(args.urls)
+        title = title[: args.max_title_length]
+
+        rss = PyRSS2Gen.RSS2(
+            title=args.title or title,
+            link=args.urls[0],
+            description=base_attrs.description
+            or base_attrs.title
+            or base_attrs.canonical
+            or ", ".join(args.urls),
+            # PyRSS2Gen ignores tzinfos and requires the date to be explicitly in UTC.
+            lastBuildDate=datetime.datetime.now(datetime.timezone.utc),
+            language=base_attrs.language,
+            items=rss_items,
+        )
+        write_feed(rss, args, keep_existing=budget.truncated)
+    finally:
+        # Also for test runs and failures, as the cookies received until
+        # then are still valid.
+        if args.cookie_jar and not args.no_cookies:
+            save_cookies_from_session(session, args.cookie_jar, loaded_cookie_keys)
 
 
 def set_locale(args):
@@ -680,21 +1954,118 @@ def set_locale(args):
             logger.warning("Ignoring wrong/unknown locale %s", loc)
 
 
-def main():
-    parser = cliargs.make_parser()
-    args = parser.parse_args()
-    set_log_level(args)
-    set_locale(args)
-
+def run_feed(args, transport=None, registry=None):
+    """Generate a single feed, writing an exception feed on failures.
+    Returns the process exit status for it. Statistics for the feed are
+    added to the metrics registry, if given.
+    """
     logger.debug("URL accept pattern: %s", args.link_pattern)
     logger.debug("URL ignore pattern: %s", args.ignore_pattern)
 
+    stats.begin(args.urls[0])
+    if args.charset_cache:
+        charsets.host_cache.load(args.charset_cache)
+    if args.trace_file:
+        tracing.begin("feed", url=args.urls[0])
+    status = 0
     try:
-        make_feed(args)
+        with profiling.profile(args):
+            make_feed(args, transport)
     except Exception as exc:
         logger.exception("Unhandled exception")
         if args.no_exception_feed:
             raise exc
         make_exception_feed(exc, args)
-        return 1
-    return 0
+        stats.count("exception_feeds")
+        status = 1
+    finally:
+        if args.charset_cache:
+            charsets.host_cache.save(args.charset_cache)
+        feed_stats = stats.end()
+        if registry is not None:
+            registry.add(feed_stats, status, args.output)
+        tracer = tracing.end()
+        if tracer:
+            tracer.root.set(status=status)
+            try:
+                tracer.export(args.trace_file)
+            except OSError:
+                logger.exception("Failed to write trace to %s", args.trace_file)
+        if args.stats:
+            print(feed_stats.format(), file=sys.stderr)
+    return status
+
+
+def run_batch(parser, args, transport, registry=None):
+    """Generate all feeds listed in the batch file, one per line, in this
+    same process. Every line has the command line arguments for a feed, and
+    options given in the actual command line apply to all of them.
+    """
+    status = 0
+    with open(args.batch, encoding="utf-8") as fp:
+        lines = fp.readlines()
+    for line_num, line in enumerate(lines, 1):
+        argv = shlex.split(line, comments=True)
+        if not argv:
+            continue
+        batch_args = copy.copy(args)
+        batch_args.batch = None
+        try:
+            feed_args = parser.parse_args(argv, namespace=batch_args)
+        except SystemExit:
+            logger.error("Invalid options in %s, line %d", args.batch, line_num)
+            status = 1
+            continue
+        if not feed_args.urls:
+            logger.error("No URL in %s, line %d", args.batch, line_num)
+            status = 1
+            continue
+        try:
+            set_log_level(feed_args)
+            set_locale(feed_args)
+            if run_feed(feed_args, transport, registry) != 0:
+                status = 1
+        except Exception:
+            logger.error("Failed to generate feed from line %d", line_num)
+            status = 1
+    return status
+
+
+def main():
+    parser = cliargs.make_parser()
+    args = parser.parse_args()
+    if not args.batch and not args.urls:
+        parser.error("at least one URL is required")
+    set_log_level(args)
+    set_locale(args)
+
+    if args.record and args.replay:
+        parser.error("options --record and --replay can not be used together")
+    if args.precompress and "br" in args.precompress and brotli is None:
+        parser.error("option --precompress br requires module brotli")
+
+    transport = Transport(
+        dns_cache_ttl=args.dns_cache_ttl,
+        record_dir=args.record,
+        replay_dir=args.replay,
+        max_body_kb=max(args.max_page_length, args.max_first_page_length),
+    )
+    registry = None
+    metrics_server = None
+    if args.metrics_file or args.metrics_port is not None:
+        registry = metrics.MetricsRegistry()
+    if args.metrics_port is not None:
+        metrics_server = metrics.MetricsServer(registry, args.metrics_port)
+        metrics_server.start()
+    try:
+        if args.interactive is not None:
+            return interactive.run(parser, args, transport)
+        if args.batch:
+            return run_batch(parser, args, transport, registry)
+        return run_feed(args, transport, registry)
+    finally:
+        transport.close()
+        if args.metrics_file:
+            registry.write(args.metrics_file)
+        if metrics_server:
+            metrics_server.close()
@@ -0,0 +1,186 @@
+#
+# newslinkrss - RSS feed generator for generic sites
+# Copyright (C) 2020  Alexandre Erwin Ittner <alexandre@ittner.com.br>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+"""Metrics about generated feeds in the Prometheus text exposition format,
+written to a file (e.g. for the node_exporter textfile collector) or served
+over HTTP while a batch runs.
+"""
+
+import http.server
+import logging
+import threading
+import time
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "newslinkrss_"
+
+# Counters from stats.FeedStats always exported, even if zero, with their
+# metric names and descriptions. Other counters are exported as they are.
+KNOWN_COUNTERS = {
+    "links": ("links", "Links collected from the start pages"),
+    "items": ("items_emitted", "Items written to the feed"),
+    "items_skipped": ("items_skipped", "Links selected that gave no item"),
+    "requests": ("http_requests", "HTTP requests sent"),
+    "bytes": ("bytes", "Bytes downloaded"),
+    "exception_feeds": ("exception_feeds", "Exception feeds written"),
+}
+
+# Caches with their hit ratios exported, computed from counters NAME_hits
+# and NAME_misses, and their descriptions.
+CACHES = {
+    "dns_cache": "name resolution cache",
+    "charset_cache": "encodings cache by host",
+    "dedup_index": "content deduplication index",
+    "url_cache": "link URL normalization cache",
+}
+
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsRegistry:
+    """Keeps the statistics for the last run of every feed, by name and
+    output file, as batch lines may share their first URL.
+    """
+
+    def __init__(self):
+        self._feeds = {}
+        self._lock = threading.Lock()
+
+    def add(self, feed_stats, status, output=None):
+        key = (feed_stats.name, output or "")
+        with self._lock:
+            self._feeds[key] = (feed_stats, status, time.time())
+
+    def format(self):
+        """Return the metrics as text in the Prometheus exposition format."""
+        with self._lock:
+            feeds = sorted(self._feeds.items())
+        metrics = {}
+
+        def add(name, help_text, labels, value):
+            if name not in metrics:
+                metrics[name] = (help_text, [])
+            label_text = ",".join(
+                '%s="%s"' % (key, escape_label(str(val))) for key, val in labels
+            )
+            metrics[name][1].append("%s%s{%s} %s" % (PREFIX, name, label_text, value))
+
+        for (name, output), (feed_stats, status, timestamp) in feeds:
+            feed = [("feed", name), ("output", output)]
+            add(
+                "last_run_timestamp_seconds",
+                "When the feed was last generated",
+                feed,
+                "%.3f" % timestamp,
+            )
+            add(
+                "duration_seconds",
+                "Time taken to generate the feed",
+                feed,
+                "%.6f" % feed_stats.duration,
+            )
+            add(
+                "success",
+                "1 if the feed was generated without errors",
+                feed,
+                int(status == 0),
+            )
+            for counter, (metric, help_text) in KNOWN_COUNTERS.items():
+                add(metric, help_text, feed, feed_stats.counters.get(counter, 0))
+            for counter, value in sorted(feed_stats.counters.items()):
+                if counter not in KNOWN_COUNTERS:
+                    add(counter, "Counter %s" % counter, feed, value)
+            for timer, value in sorted(feed_stats.timers.items()):
+                add(
+                    timer + "_seconds",
+                    "Time spent in %s" % timer,
+                    feed,
+                    "%.6f" % value,
+                )
+            for code, value in sorted(feed_stats.http_status.items()):
+                add(
+                    "http_responses",
+                    "HTTP responses received by status code",
+                    feed + [("status", code)],
+                    value,
+                )
+            for cache, cache_text in CACHES.items():
+                hits = feed_stats.counters.get(cache + "_hits", 0)
+                lookups = hits + feed_stats.counters.get(cache + "_misses", 0)
+                if lookups:
+                    add(
+                        cache + "_hit_ratio",
+                        "Fraction of lookups found in the %s" % cache_text,
+                        feed,
+                        "%.4f" % (hits / lookups),
+                    )
+
+        lines = []
+        for name, (help_text, samples) in metrics.items():
+            lines.append("# HELP %s%s %s" % (PREFIX, name, help_text))
+            lines.append("# TYPE %s%s gauge" % (PREFIX, name))
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename):
+        """Write the metrics to a file, atomically, so collectors never see
+        a partially written one.
+        """
+        try:
+            utils.write_file_atomically(filename, self.format().encode("utf-8"))
+        except OSError:
+            logger.exception("Failed to write metrics to %s", filename)
+
+
+class MetricsServer:
+    """Serves the metrics from a registry at /metrics in a background
+    thread, for scraping while a long batch runs.
+    """
+
+    def __init__(self, registry, port, address="127.0.0.1"):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.format().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                logger.debug("Metrics server: " + fmt, *args)
+
+        self.server = http.server.ThreadingHTTPServer((address, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        logger.info("Serving metrics on port %d", self.server.server_address[1])
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -21,27 +21,35 @@ import logging
 from html.parser import HTMLParser
 import re
 
-import dateutil.parser
-import requests
-
 from . import utils
+from .records import Link
 
 
 logger = logging.getLogger(__name__)
 
 
 class CollectLinksParser(HTMLParser):
-    def __init__(self, url_patt=None, ignore_patt=None, max_items=None, base_url=None):
+    def __init__(
+        self,
+        url_patt=None,
+        ignore_patt=None,
+        max_items=None,
+        base_url=None,
+        url_normalizer=None,
+    ):
         HTMLParser.__init__(self)
         self.url_patt = url_patt
         self.ignore_patt = ignore_patt
         self.max_items = max_items
         self.base_url = base_url
+        # URL of the page being parsed, saved in the collected links.
+        self.source_url = base_url
         self.links = []
         self.limit_reached = False
 
-        # List of regexes with parameters to strip from URL query strings.
-        self.qs_cleanup_rx_list = []
+        # Makes absolute URLs and strips unwanted query string parameters;
+        # may be shared by parsers for pages from the same site.
+        self.url_normalizer = url_normalizer or utils.UrlNormalizer()
 
         self._found_links = set()
         self._last_link_text = None
@@ -66,10 +74,7 @@ class CollectLinksParser(HTMLParser):
             if not href:
                 return
 
-            href = href.split("#", 2)[0]  # Strip URL fragment.
-            if self.base_url:
-                href = requests.compat.urljoin(self.base_url, href)
-            href = utils.clean_url_query_string(self.qs_cleanup_rx_list, href)
+            href = self.url_normalizer.normalize(href, self.base_url)
 
             # Try to noe follow the same link more than once. We need to
             # repeat this check later due to redirects.
@@ -101,10 +106,57 @@ class CollectLinksParser(HTMLParser):
                 link_text = " ".join(self._last_link_text)
             if self._last_link and self._last_link not in self._found_links:
                 self._found_links.add(self._last_link)
-                self.links.append((self._last_link, link_text))
+                self.links.append(
+                    Link(
+                        self._last_link, link_text, self.source_url, len(self.links)
+                    )
+                )
                 logger.info("New link added: %s %s", self._last_link, link_text)
             self._last_link = False
 
+    def add_link(self, url, text="", date=None):
+        """Add a link found by other means than parsing HTML (e.g. from a
+        sitemap), subject to the same patterns and limits. Returns True if
+        the link was added.
+        """
+        if (self.max_items is not None) and (len(self.links) >= self.max_items):
+            if not self.limit_reached:
+                logger.warning("limit of %d links reached", self.max_items)
+            self.limit_reached = True
+            return False
+        url = self.url_normalizer.normalize(url, self.base_url)
+        if url in self._found_links or not self.test_url_patterns(url):
+            return False
+        self._found_links.add(url)
+        self.links.append(Link(url, text, self.source_url, len(self.links), date))
+        logger.info("New link added: %s %s", url, text)
+        return True
+
+    def merge(self, other):
+        """Add the links collected by another parser (e.g. for a single
+        page, parsed separately), as if they were found by this one.
+
+        The limit is only reached if this parser is full and some links
+        were left out, either here or by the other parser; links already
+        found by this one do not count.
+        """
+        left_out = other.limit_reached
+        for link in other.links:
+            if link.url in self._found_links:
+                continue
+            if (self.max_items is not None) and (len(self.links) >= self.max_items):
+                left_out = True
+                break
+            self._found_links.add(link.url)
+            self.links.append(
+                Link(link.url, link.text, link.source_url, len(self.links), link.date)
+            )
+        full = (self.max_items is not None) and (len(self.links) >= self.max_items)
+        if full and left_out:
+            if not self.limit_reached:
+                logger.warning("limit of %d links reached", self.max_items)
+            self.limit_reached = True
+
 
 class CollectAttributesParser(HTMLParser):
     """A state machine that parses HTML from a web page and extract some
@@ -120,12 +172,22 @@ class CollectAttributesParser(HTMLParser):
     section   - Section where article was published or None
     tags      - Tags attached to the article
     language  - Language code (e.g. en-US) or None
+    alternate_feeds - URLs of RSS or Atom feeds announced by the page
+
+    All this information is in the document <head>, so the parser stops
+    once it ends and property 'head_done' is set to True; further calls to
+    feed() are just ignored.
     """
 
+    # Amount of text handed to HTMLParser at once, so feed() can stop soon
+    # after the end of <head> without tokenizing the rest of the page.
+    FEED_CHUNK_SIZE = 8192
+
     def __init__(self):
         HTMLParser.__init__(self)
         self._title_lst = None
         self._in_head = False
+        self.head_done = False
         self.title = None
         self.base = None
         self.description = None
@@ -135,6 +197,7 @@ class CollectAttributesParser(HTMLParser):
         self.section = None
         self.tags = []
         self.language = None
+        self.alternate_feeds = []
 
         # True is a temporary language was found in element <html>. It will
         # be used only until another one is found because too many sites
@@ -146,8 +209,19 @@ class CollectAttributesParser(HTMLParser):
         self._title_lst = None
         self._in_head = False
         self._html_locale = False
+        self.head_done = False
+
+    def feed(self, data):
+        for pos in range(0, len(data), self.FEED_CHUNK_SIZE):
+            if self.head_done:
+                break
+            HTMLParser.feed(self, data[pos : pos + self.FEED_CHUNK_SIZE])
 
     def handle_starttag(self, tag, attrs):
+        if tag == "body" and not self._in_head:
+            # Pages without a <head>; nothing else to find.
+            self.head_done = True
+
         if tag == "html":
             lang = utils.first_valid_attr_in_list(attrs, "lang")
             if lang and not self.language:
@@ -170,6 +244,14 @@ class CollectAttributesParser(HTMLParser):
             href = utils.first_valid_attr_in_list(attrs, "href")
             if rel == "canonical" and not self.canonical:
                 self.canonical = href
+            link_type = utils.first_valid_attr_in_list(attrs, "type")
+            if (
+                rel == "alternate"
+                and href
+                and link_type in ("application/rss+xml", "application/atom+xml")
+                and href not in self.alternate_feeds
+            ):
+                self.alternate_feeds.append(href)
 
         if self._in_head and tag.lower() == "meta":
             # <meta name="xxxx" content="yyyy" />
@@ -198,7 +280,7 @@ class CollectAttributesParser(HTMLParser):
                 # <meta property="article:published_time" content="2020-09-13T20:00:00+00:00" />
                 # <meta property="article:modified_time" content="2020-09-13T20:01:42+00:00" />
                 try:
-                    dt = dateutil.parser.parse(content)
+                    dt = utils.parse_date(content, "meta")
                     if (not self.changed) or (self.changed < dt):
                         self.changed = dt
                         logger.debug("Found new changed date %s", dt)
@@ -244,6 +326,7 @@ class CollectAttributesParser(HTMLParser):
     def handle_endtag(self, tag):
         if tag == "head":
             self._in_head = False
+            self.head_done = True
 
         if tag == "title" and self._title_lst is not None:
             self.title = "".join(self._title_lst)
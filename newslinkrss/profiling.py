@@ -0,0 +1,288 @@
+#
+# newslinkrss - RSS feed generator for generic sites
+# Copyright (C) 2020  Alexandre Erwin Ittner <alexandre@ittner.com.br>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+"""Profiling of the generation of a feed, for option --profile.
+
+A profiler is started for every feed and writes its report next to the
+feed file when done. Reports are split by stage, with the same names used
+by stats.timed() (fetch, parse, body, etc.), which tells the profiler when
+a stage starts and ends through stage(). Only one feed is profiled at a
+time; stage() is a no-op if there is no current profiler.
+"""
+
+import contextlib
+import cProfile
+import dis
+import logging
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+# Number of functions or source lines listed in the reports.
+TOP_COUNT = 25
+
+# Frames kept in the traceback of every allocation, enough to reach the
+# function of the stage from within lxml and requests calls.
+TRACEMALLOC_FRAMES = 25
+
+# Modules with the context managers wrapping the profiled stages.
+INTERNAL_MODULES = ("contextlib", __name__, __package__ + ".stats")
+
+
+def report_base_name(args):
+    return args.output or "newslinkrss"
+
+
+class CpuProfiler:
+    """Profile with cProfile, writing the raw data to a .pstats file and a
+    text summary by stage to a .cpu.txt file.
+
+    cProfile only profiles the thread that enables it before Python 3.12,
+    so every thread started while profiling gets its own profiler and the
+    data from all of them is merged in the end. A profiler can only be
+    disabled by its own thread, so the threads are expected to end with
+    the feed (as the ones from the thread pools do); profilers of threads
+    still running are left enabled and their data is incomplete.
+    """
+
+    def __init__(self, base_name):
+        self.base_name = base_name
+        self.stage_times = {}
+        self._profiles = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _add_profile(self):
+        prof = cProfile.Profile()
+        with self._lock:
+            self._profiles.append((threading.current_thread(), prof))
+        return prof
+
+    def _thread_started(self, frame, event, arg):
+        # Called on the first event of a new thread; enabling the profiler
+        # replaces this function as the profile hook for the thread.
+        self._add_profile().enable()
+
+    def start(self):
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._thread_started)
+        self._add_profile().enable()
+
+    def stop(self):
+        if sys.version_info < (3, 12):
+            threading.setprofile(None)
+        with self._lock:
+            profiles = list(self._profiles)
+        current = threading.current_thread()
+        for thread, prof in profiles:
+            if thread is current:
+                prof.disable()
+            elif thread.is_alive():
+                logger.warning(
+                    "Thread %s still running, its CPU profile is incomplete",
+                    thread.name,
+                )
+        return pstats.Stats(*(prof for _, prof in profiles))
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # CPU time of the thread, so stages running concurrently in other
+        # threads are not counted.
+        start = time.thread_time()
+        try:
+            yield
+        finally:
+            elapsed = time.thread_time() - start
+            with self._lock:
+                count, total = self.stage_times.get(name, (0, 0.0))
+                self.stage_times[name] = (count + 1, total + elapsed)
+
+    def write_report(self, profile_stats):
+        pstats_filename = self.base_name + ".pstats"
+        report_filename = self.base_name + ".cpu.txt"
+        profile_stats.dump_stats(pstats_filename)
+        with open(report_filename, "w", encoding="utf-8") as fp:
+            fp.write("CPU time by stage (including nested stages):\n\n")
+            for name, (count, total) in sorted(
+                self.stage_times.items(), key=lambda entry: -entry[1][1]
+            ):
+                fp.write("%10.3fs %6d calls  %s\n" % (total, count, name))
+            fp.write("\nTop %d functions by cumulative time:\n\n" % TOP_COUNT)
+            profile_stats.stream = fp
+            profile_stats.sort_stats("cumulative").print_stats(TOP_COUNT)
+        logger.info(
+            "CPU profile written to %s and %s", pstats_filename, report_filename
+        )
+
+
+class MemoryProfiler:
+    """Profile memory allocations with tracemalloc, writing a report with
+    the top allocations to a .mem.txt file.
+
+    Allocations are attributed to the innermost stage whose function is in
+    their traceback. The allocations listed are the ones alive at the end
+    of the stage with the highest memory usage, which are usually the
+    culprits of a high peak; a snapshot is taken whenever a stage ends with
+    more memory in use than any before it.
+    """
+
+    # Minimum growth, over the last snapshot, to take a new one; snapshots
+    # are expensive when there are lots of allocations.
+    SNAPSHOT_GROWTH = 1.1
+
+    def __init__(self, base_name):
+        self.base_name = base_name
+        self.stage_peaks = {}
+        self.snapshot = None
+        self.snapshot_stage = None
+        self._snapshot_size = 0
+        # Code locations of the functions with each stage, as (filename,
+        # first line, last line) tuples.
+        self._stage_code = {}
+        self._code_locations = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+
+    def stop(self):
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        location = self._caller_location()
+        try:
+            yield
+        finally:
+            current = tracemalloc.get_traced_memory()[0]
+            with self._lock:
+                self._stage_code.setdefault(name, set()).add(location)
+                self.stage_peaks[name] = max(self.stage_peaks.get(name, 0), current)
+                take_snapshot = current > self._snapshot_size * self.SNAPSHOT_GROWTH
+                if take_snapshot:
+                    self._snapshot_size = current
+            if take_snapshot:
+                snapshot = tracemalloc.take_snapshot()
+                with self._lock:
+                    self.snapshot = snapshot
+                    self.snapshot_stage = name
+
+    def _caller_location(self):
+        """Find the code location of the function with the block being
+        profiled, skipping the frames from the context managers.
+        """
+        frame = sys._getframe(1)
+        while frame.f_globals.get("__name__") in INTERNAL_MODULES:
+            frame = frame.f_back
+        code = frame.f_code
+        location = self._code_locations.get(code)
+        if location is None:
+            # Instructions without a line number give None since 3.13.
+            lines = [
+                line for _, line in dis.findlinestarts(code) if line is not None
+            ] or [code.co_firstlineno]
+            location = (code.co_filename, min(lines), max(lines))
+            self._code_locations[code] = location
+        return location
+
+    def find_stage(self, traceback):
+        for frame in reversed(traceback):
+            for name, locations in self._stage_code.items():
+                for filename, first, last in locations:
+                    if frame.filename == filename and first <= frame.lineno <= last:
+                        return name
+        return "(other)"
+
+    def write_report(self, peak):
+        report_filename = self.base_name + ".mem.txt"
+        with open(report_filename, "w", encoding="utf-8") as fp:
+            fp.write("Peak traced memory: %.1f KiB\n\n" % (peak / 1024))
+            fp.write("Memory in use at the end of each stage (maximum):\n\n")
+            for name, size in sorted(
+                self.stage_peaks.items(), key=lambda entry: -entry[1]
+            ):
+                fp.write("%12.1f KiB  %s\n" % (size / 1024, name))
+            if self.snapshot is not None:
+                snapshot = self.snapshot.filter_traces(
+                    [tracemalloc.Filter(False, tracemalloc.__file__)]
+                )
+                by_stage = {}
+                for trace in snapshot.traces:
+                    name = self.find_stage(trace.traceback)
+                    count, size = by_stage.get(name, (0, 0))
+                    by_stage[name] = (count + 1, size + trace.size)
+                fp.write(
+                    "\nAllocations alive at the end of stage %s, by stage:\n\n"
+                    % self.snapshot_stage
+                )
+                for name, (count, size) in sorted(
+                    by_stage.items(), key=lambda entry: -entry[1][1]
+                ):
+                    fp.write("%12.1f KiB %8d blocks  %s\n" % (size / 1024, count, name))
+                fp.write("\nTop %d allocations by source line:\n\n" % TOP_COUNT)
+                for stat in snapshot.statistics("lineno")[:TOP_COUNT]:
+                    fp.write(
+                        "%12.1f KiB %8d blocks  %s\n"
+                        % (stat.size / 1024, stat.count, stat.traceback[0])
+                    )
+        logger.info("Memory profile written to %s", report_filename)
+
+
+_current = None
+
+
+@contextlib.contextmanager
+def profile(args):
+    """Profile the block according to option --profile, if given."""
+    global _current
+    if not args.profile:
+        yield
+        return
+    base_name = report_base_name(args)
+    if args.profile == "cpu":
+        profiler = CpuProfiler(base_name)
+    else:
+        profiler = MemoryProfiler(base_name)
+    _current = profiler
+    profiler.start()
+    try:
+        yield
+    finally:
+        result = profiler.stop()
+        _current = None
+        try:
+            profiler.write_report(result)
+        except OSError:
+            logger.exception("Failed to write profile for %s", base_name)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Attribute the block to the given stage in the current profile."""
+    if _current is None:
+        yield
+        return
+    with _current.stage(name):
+        yield
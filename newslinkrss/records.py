@@ -0,0 +1,135 @@
+#
+# newslinkrss - RSS feed generator for generic sites
+# Copyright (C) 2020  Alexandre Erwin Ittner <alexandre@ittner.com.br>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+"""Compact records passed among the stages of feed generation.
+
+These use __slots__ as there may be many thousands of them alive in large
+runs, and only hold plain values so they are cheap to pickle.
+"""
+
+import PyRSS2Gen
+
+
+class Link:
+    """A link collected from a source page, candidate for a feed item.
+
+    url        - Absolute URL of the link
+    text       - Text of the link (may be empty)
+    source_url - URL of the page where the link was found, or None
+    position   - Order of the link among all collected links
+    date       - Date known for the link before following it, or None
+    """
+
+    __slots__ = ("url", "text", "source_url", "position", "date")
+
+    def __init__(self, url, text="", source_url=None, position=0, date=None):
+        self.url = url
+        self.text = text
+        self.source_url = source_url
+        self.position = position
+        self.date = date
+
+    def __repr__(self):
+        return "Link(%r, %r, %r, %d)" % (
+            self.url,
+            self.text,
+            self.source_url,
+            self.position,
+        )
+
+
+class Page:
+    """A page downloaded for a followed link.
+
+    url         - Final URL of the page, after redirects
+    status_code - HTTP status code
+    headers     - Case-insensitive dictionary with the response headers
+    text        - Page contents, as text
+    """
+
+    __slots__ = ("url", "status_code", "headers", "text")
+
+    def __init__(self, url, status_code, headers, text):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+
+    def __repr__(self):
+        return "Page(%r, %d)" % (self.url, self.status_code)
+
+
+class Item:
+    """Information extracted for a feed item.
+
+    title       - Item title
+    link        - URL of the item (usually the canonical one)
+    description - Description or complete body, in HTML
+    guid        - Globally unique identifier for the item (an URL)
+    author      - Author name or None
+    categories  - List of category names
+    date        - Publishing date as a datetime in UTC, or None
+    fingerprints - Content fingerprints not yet checked for duplicates,
+                  or None
+    """
+
+    __slots__ = (
+        "title",
+        "link",
+        "description",
+        "guid",
+        "author",
+        "categories",
+        "date",
+        "fingerprints",
+    )
+
+    def __init__(
+        self,
+        title,
+        link,
+        description,
+        guid,
+        author=None,
+        categories=None,
+        date=None,
+        fingerprints=None,
+    ):
+        self.title = title
+        self.link = link
+        self.description = description
+        self.guid = guid
+        self.author = author
+        self.categories = categories or []
+        self.date = date
+        self.fingerprints = fingerprints
+
+    def __repr__(self):
+        return "Item(%r, %r)" % (self.title, self.link)
+
+    def to_rss_item(self):
+        return PyRSS2Gen.RSSItem(
+            title=self.title,
+            link=self.link,
+            author=self.author,
+            description=self.description,
+            guid=PyRSS2Gen.Guid(self.guid),
+            categories=self.categories,
+            pubDate=self.date,
+        )
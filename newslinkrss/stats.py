@@ -0,0 +1,164 @@
+#
+# newslinkrss - RSS feed generator for generic sites
+# Copyright (C) 2020  Alexandre Erwin Ittner <alexandre@ittner.com.br>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+"""Collection of statistics about the generation of a feed.
+
+Only one feed is generated at a time, so statistics are collected in the
+"current" FeedStats object, set by begin() and cleared by end(). Functions
+in this module are no-ops if there is no current object.
+"""
+
+import collections
+import contextlib
+import threading
+import time
+
+from . import profiling
+from . import tracing
+from . import utils
+
+
+class FeedStats:
+    """Counters and timers for the generation of a single feed.
+
+    name     - Name identifying the feed (e.g. its first URL)
+    counters - Counter with the number of events/amounts by name
+    timers   - Dictionary with the accumulated time, in seconds, by name
+    http_status - Counter with the number of HTTP responses by status code
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start_time = time.monotonic()
+        self.end_time = None
+        self.counters = collections.Counter()
+        self.timers = collections.defaultdict(float)
+        self.http_status = collections.Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def duration(self):
+        end_time = self.end_time or time.monotonic()
+        return end_time - self.start_time
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.timers[name] += seconds
+
+    def count_status(self, status_code):
+        with self._lock:
+            self.http_status[status_code] += 1
+
+    def merge(self, counters, timers, http_status):
+        """Add the counts and times collected by another FeedStats (e.g.
+        in a worker process), given as dictionaries.
+        """
+        with self._lock:
+            self.counters.update(counters)
+            for name, seconds in timers.items():
+                self.timers[name] += seconds
+            self.http_status.update(http_status)
+
+    def export(self):
+        """Return the counters, timers and HTTP status counts as plain
+        dictionaries, to be given to merge() in another process.
+        """
+        with self._lock:
+            return dict(self.counters), dict(self.timers), dict(self.http_status)
+
+    def format(self):
+        """Format the statistics as a single line of text."""
+        fields = ["feed=%s" % self.name, "duration=%.3fs" % self.duration]
+        fields.extend("%s=%d" % (k, v) for k, v in sorted(self.counters.items()))
+        fields.extend("%s=%.3fs" % (k, v) for k, v in sorted(self.timers.items()))
+        fields.extend(
+            "http_%d=%d" % (k, v) for k, v in sorted(self.http_status.items())
+        )
+        return "newslinkrss stats: " + " ".join(fields)
+
+
+_current = None
+
+
+def begin(name):
+    """Start collecting statistics for a new feed."""
+    global _current
+    _current = FeedStats(name)
+    return _current
+
+
+def end():
+    """Stop collecting statistics for the current feed and return them."""
+    global _current
+    feed_stats, _current = _current, None
+    if feed_stats:
+        feed_stats.end_time = time.monotonic()
+        # These are for the entire process, so they include any previous
+        # feeds in the same run.
+        peak_rss = utils.get_peak_memory_usage()
+        if peak_rss is not None:
+            feed_stats.counters["peak_rss_kb"] = peak_rss
+        # Child processes include the workers from --cpu-workers.
+        children_peak_rss = utils.get_peak_memory_usage(children=True)
+        if children_peak_rss:
+            feed_stats.counters["children_peak_rss_kb"] = children_peak_rss
+    return feed_stats
+
+
+def current():
+    return _current
+
+
+def merge(counters, timers, http_status):
+    if _current:
+        _current.merge(counters, timers, http_status)
+
+
+def count(name, value=1):
+    if _current:
+        _current.count(name, value)
+
+
+def add_time(name, seconds):
+    if _current:
+        _current.add_time(name, seconds)
+
+
+def count_status(status_code):
+    if _current:
+        _current.count_status(status_code)
+
+
+@contextlib.contextmanager
+def timed(name, **attributes):
+    """Context manager adding the time spent in its block to timer 'name'.
+    The block is also recorded as a tracing span with the given attributes;
+    the span is returned, or None if not tracing. It is also a stage for
+    profiling.
+    """
+    start = time.monotonic()
+    with tracing.span(name, **attributes) as span, profiling.stage(name):
+        try:
+            yield span
+        finally:
+            add_time(name, time.monotonic() - start)
@@ -0,0 +1,179 @@
+#
+# newslinkrss - RSS feed generator for generic sites
+# Copyright (C) 2020  Alexandre Erwin Ittner <alexandre@ittner.com.br>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+"""Tracing spans for the generation of feeds, exported to a file in the
+OpenTelemetry Protocol (OTLP) JSON format.
+
+As with module stats, there is a "current" tracer for the feed being
+generated, set by begin() and cleared by end(), and span() is a no-op if
+there is none. Every feed is a trace with a root span; the other spans are
+nested according to the calls to span() in the same thread, or directly
+under the root span for other threads.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class Span:
+    __slots__ = (
+        "name",
+        "span_id",
+        "parent_id",
+        "start_ns",
+        "end_ns",
+        "attributes",
+    )
+
+    def __init__(self, name, parent_id, attributes):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes)
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Tracer:
+    """Spans for a single feed, sharing the same trace id."""
+
+    def __init__(self, name, **attributes):
+        self.trace_id = os.urandom(16).hex()
+        self.spans = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.root = Span(name, None, attributes)
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = [self.root]
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        stack = self._stack()
+        span = Span(name, stack[-1].span_id, attributes)
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            span.end_ns = time.time_ns()
+            stack.pop()
+            with self._lock:
+                self.spans.append(span)
+
+    def adopt(self, spans, root_id):
+        """Add spans recorded by another tracer (e.g. in a worker process),
+        putting the ones directly under its root span, given by root_id,
+        under the span of the current thread.
+        """
+        parent_id = self._stack()[-1].span_id
+        for span in spans:
+            if span.parent_id == root_id:
+                span.parent_id = parent_id
+        with self._lock:
+            self.spans.extend(spans)
+
+    def to_otlp(self):
+        """Return the trace as an OTLP ExportTraceServiceRequest object."""
+        spans = []
+        for span in [self.root] + self.spans:
+            otlp_span = {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 1,
+                "startTimeUnixNano": str(span.start_ns),
+                "endTimeUnixNano": str(span.end_ns or time.time_ns()),
+                "attributes": [
+                    {"key": key, "value": otlp_value(value)}
+                    for key, value in span.attributes.items()
+                    if value is not None
+                ],
+            }
+            if span.parent_id:
+                otlp_span["parentSpanId"] = span.parent_id
+            spans.append(otlp_span)
+        service = {"key": "service.name", "value": {"stringValue": "newslinkrss"}}
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": [service]},
+                    "scopeSpans": [{"scope": {"name": "newslinkrss"}, "spans": spans}],
+                }
+            ]
+        }
+
+    def export(self, filename):
+        """Append the trace to the file as a line of JSON, as done by the
+        OpenTelemetry file exporters.
+        """
+        with open(filename, "a", encoding="utf-8") as fp:
+            fp.write(json.dumps(self.to_otlp(), separators=(",", ":")) + "\n")
+
+
+_current = None
+
+
+def begin(name, **attributes):
+    """Start tracing a new feed."""
+    global _current
+    _current = Tracer(name, **attributes)
+    return _current
+
+
+def end():
+    """Stop tracing the current feed and return its tracer."""
+    global _current
+    tracer, _current = _current, None
+    if tracer:
+        tracer.root.end_ns = time.time_ns()
+    return tracer
+
+
+def current():
+    return _current
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Context manager recording its block as a span of the current trace.
+    Yields the Span, so attributes may be added, or None if not tracing.
+    """
+    if _current is None:
+        yield None
+    else:
+        with _current.span(name, **attributes) as new_span:
+            yield new_span
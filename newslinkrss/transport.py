@@ -0,0 +1,324 @@
+#
+# newslinkrss - RSS feed generator for generic sites
+# Copyright (C) 2020  Alexandre Erwin Ittner <alexandre@ittner.com.br>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+"""Long-lived HTTP transport layer, shared among the feeds generated by the
+same process (e.g. with option --batch) so connections and name resolution
+results are reused instead of being set up again for every feed.
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+import requests
+import urllib3
+
+try:
+    from urllib3 import HTTPHeaderDict
+except ImportError:
+    # Only exported from the package since urllib3 2.0.
+    from urllib3._collections import HTTPHeaderDict
+
+from . import stats
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+
+class DnsCache:
+    """In-process cache for name resolution results with a fixed TTL.
+
+    Python does not cache name resolution results, so every new connection
+    to a host does a new lookup. Once installed, this class replaces
+    socket.getaddrinfo (used by urllib3 to open connections) with a cached
+    version.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._orig_getaddrinfo = None
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        key = (host, port, family, type, proto, flags)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry and entry[0] > now:
+            stats.count("dns_cache_hits")
+            return entry[1]
+        start = time.monotonic()
+        result = self._orig_getaddrinfo(host, port, family, type, proto, flags)
+        stats.add_time("dns_lookup", time.monotonic() - start)
+        stats.count("dns_cache_misses")
+        with self._lock:
+            self._cache[key] = (now + self.ttl, result)
+        return result
+
+    def install(self):
+        if self._orig_getaddrinfo is None:
+            self._orig_getaddrinfo = socket.getaddrinfo
+            socket.getaddrinfo = self.getaddrinfo
+
+    def uninstall(self):
+        if self._orig_getaddrinfo is not None:
+            socket.getaddrinfo = self._orig_getaddrinfo
+            self._orig_getaddrinfo = None
+
+
+class TimedHTTPConnection(urllib3.connection.HTTPConnection):
+    def connect(self):
+        start = time.monotonic()
+        try:
+            super().connect()
+        finally:
+            stats.add_time("connect", time.monotonic() - start)
+            stats.count("connections")
+
+
+class TimedHTTPSConnection(urllib3.connection.HTTPSConnection):
+    def connect(self):
+        # Includes the TLS handshake.
+        start = time.monotonic()
+        try:
+            super().connect()
+        finally:
+            stats.add_time("connect", time.monotonic() - start)
+            stats.count("connections")
+
+
+class TimedHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(urllib3.connectionpool.HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class StatsHTTPAdapter(requests.adapters.HTTPAdapter):
+    """A HTTP adapter that collects statistics about requests and the
+    connections opened for them.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool,
+        }
+
+    def send(self, request, *args, **kwargs):
+        resp = super().send(request, *args, **kwargs)
+        stats.count("requests")
+        stats.count_status(resp.status_code)
+        return resp
+
+
+class HttpArchive:
+    """Directory with recorded HTTP responses, for --record and --replay.
+
+    Every response is stored as two files named from a hash of the request
+    method and URL: one with the status and headers, as JSON, and the other
+    with the body, already decoded (i.e. without any Content-Encoding).
+    """
+
+    # Headers that no longer apply once the body is stored decoded.
+    DROPPED_HEADERS = ("content-encoding", "transfer-encoding")
+
+    def __init__(self, path):
+        self.path = path
+
+    def _base_name(self, method, url):
+        key = hashlib.sha1(("%s %s" % (method, url)).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, key)
+
+    def save(self, method, url, status, reason, headers, body):
+        base_name = self._base_name(method, url)
+        meta = {
+            "method": method,
+            "url": url,
+            "status": status,
+            "reason": reason,
+            "headers": [
+                [name, value]
+                for name, value in headers
+                if name.lower() not in self.DROPPED_HEADERS
+            ],
+        }
+        os.makedirs(self.path, exist_ok=True)
+        utils.write_file_atomically(base_name + ".body", body)
+        # Written last, so entries without a body are never seen.
+        utils.write_file_atomically(
+            base_name + ".json", json.dumps(meta, indent=1).encode("utf-8")
+        )
+        return meta
+
+    def load(self, method, url):
+        """Return the metadata and body recorded for the request, or None."""
+        base_name = self._base_name(method, url)
+        try:
+            with open(base_name + ".json", encoding="utf-8") as fp:
+                meta = json.load(fp)
+            with open(base_name + ".body", "rb") as fp:
+                body = fp.read()
+        except FileNotFoundError:
+            return None
+        return meta, body
+
+
+def make_raw_response(meta, body):
+    """Make a urllib3 response for a recorded entry, as if it came from the
+    network.
+    """
+    headers = HTTPHeaderDict()
+    for name, value in meta["headers"]:
+        headers.add(name, value)
+    return urllib3.HTTPResponse(
+        body=io.BytesIO(body),
+        headers=headers,
+        status=meta["status"],
+        reason=meta["reason"],
+        preload_content=False,
+        decode_content=False,
+        enforce_content_length=False,
+        request_method=meta["method"],
+        request_url=meta["url"],
+    )
+
+
+class RecordingHTTPAdapter(StatsHTTPAdapter):
+    """A HTTP adapter that saves every response to a HttpArchive, up to
+    max_body_kb kilobytes of its body.
+    """
+
+    def __init__(self, archive, max_body_kb, **kwargs):
+        super().__init__(**kwargs)
+        self.archive = archive
+        self.max_body_kb = max_body_kb
+
+    def with_max_body(self, max_body_kb):
+        """Return an adapter recording to the same archive, with another
+        limit for bodies, that shares the connection pools with this one.
+        """
+        adapter = RecordingHTTPAdapter(self.archive, max_body_kb)
+        adapter.poolmanager = self.poolmanager
+        adapter.proxy_manager = self.proxy_manager
+        return adapter
+
+    def send(self, request, stream=False, *args, **kwargs):
+        resp = super().send(request, True, *args, **kwargs)
+        try:
+            max_bytes = 1024 * self.max_body_kb
+            body = resp.raw.read(max_bytes, decode_content=True)
+            if len(body) >= max_bytes:
+                logger.warning(
+                    "Recording only %d kB from %s", self.max_body_kb, resp.url
+                )
+            meta = self.archive.save(
+                request.method,
+                request.url,
+                resp.status_code,
+                resp.reason,
+                resp.raw.headers.items(),
+                body,
+            )
+        finally:
+            resp.close()
+        logger.debug("Recorded %s %s", request.method, request.url)
+        return self.build_response(request, make_raw_response(meta, body))
+
+
+class ReplayHTTPAdapter(requests.adapters.HTTPAdapter):
+    """A HTTP adapter that serves responses from a HttpArchive instead of
+    the network; requests not recorded fail with a ConnectionError.
+    """
+
+    def __init__(self, archive, **kwargs):
+        super().__init__(**kwargs)
+        self.archive = archive
+
+    def send(self, request, *args, **kwargs):
+        entry = self.archive.load(request.method, request.url)
+        if entry is None:
+            raise requests.exceptions.ConnectionError(
+                "No recorded response for %s %s" % (request.method, request.url),
+                request=request,
+            )
+        logger.debug("Replaying %s %s", request.method, request.url)
+        resp = self.build_response(request, make_raw_response(*entry))
+        stats.count("requests")
+        stats.count_status(resp.status_code)
+        return resp
+
+
+class Transport:
+    """Connection pools and name resolution cache shared by all sessions
+    created from it. Sessions keep their own headers and cookies, so feeds
+    are still isolated from each other.
+    """
+
+    def __init__(
+        self,
+        dns_cache_ttl=0,
+        pool_connections=32,
+        record_dir=None,
+        replay_dir=None,
+        max_body_kb=2048,
+    ):
+        if replay_dir:
+            self.adapter = ReplayHTTPAdapter(HttpArchive(replay_dir))
+        elif record_dir:
+            self.adapter = RecordingHTTPAdapter(
+                HttpArchive(record_dir),
+                max_body_kb,
+                pool_connections=pool_connections,
+            )
+        else:
+            self.adapter = StatsHTTPAdapter(pool_connections=pool_connections)
+        self.dns_cache = None
+        if dns_cache_ttl:
+            self.dns_cache = DnsCache(dns_cache_ttl)
+            self.dns_cache.install()
+
+    def make_session(self, max_body_kb=None):
+        """Make a new session using the shared connection pools. Do not
+        call close() on it, as this would close the pools too.
+
+        If recording, max_body_kb replaces the limit given to the transport
+        for the responses recorded through this session.
+        """
+        adapter = self.adapter
+        if max_body_kb is not None and isinstance(adapter, RecordingHTTPAdapter):
+            adapter = adapter.with_max_body(max_body_kb)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def close(self):
+        self.adapter.close()
+        if self.dns_cache:
+            self.dns_cache.uninstall()
+            self.dns_cache = None
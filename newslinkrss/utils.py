@@ -16,12 +16,32 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 
+import collections
+import contextlib
 import datetime
+import email.utils
 import logging
+import os
 import re
+import stat
+import sys
+import tempfile
+import time
 import urllib
 import dateutil.parser
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows; file locks become no-ops there.
+    fcntl = None
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; memory usage is not reported there.
+    resource = None
+
 logger = logging.getLogger(__name__)
 
 
@@ -55,33 +75,214 @@ def normalize_rfc1766_lang_tag(loc):
     return loc
 
 
-def clean_url_query_string(rx_list, url):
-    """Remove unwanted parameters from the URL query string.
+class UrlNormalizer:
+    """Make absolute, normalized URLs from the links found in pages.
+
+    The fragment is removed, scheme and host name are made lowercase, and
+    default ports are dropped, so the same URL is always written the same
+    way. Query string parameters with names matching any of the regular
+    expressions in qs_remove_param (as option -Q) are also removed.
 
-    If the URL has a query string, remove all name/value pairs with names
-    matching any of the regular expressions given in list 'rx_list'.
-    Return the URL, possibly modified.
+    Pages repeat the same links over and over (menus, footers, etc.), so
+    results are remembered for every base URL and link.
     """
 
-    if not rx_list:
+    DEFAULT_PORTS = {"http": ":80", "https": ":443"}
+
+    # Maximum number of results remembered; the cache is simply emptied
+    # once it is full.
+    CACHE_SIZE = 4096
+
+    def __init__(self, qs_remove_param=None):
+        self.qs_remove_rx_list = [re.compile(rx) for rx in qs_remove_param or []]
+        self._cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def normalize(self, href, base_url=None):
+        key = (base_url, href)
+        url = self._cache.get(key)
+        if url is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            url = href.split("#", 1)[0]
+            if base_url:
+                url = urllib.parse.urljoin(base_url, url)
+            url = self.normalize_host(url)
+            if self.qs_remove_rx_list and "?" in url:
+                url = self.clean_query_string(url)
+            if len(self._cache) >= self.CACHE_SIZE:
+                self._cache.clear()
+            self._cache[key] = url
         return url
 
-    u = urllib.parse.urlparse(url)
-    query_lst = urllib.parse.parse_qsl(u.query, keep_blank_values=True)
-    for rx in rx_list:
-        nlst = []
-        for itm in query_lst:
-            if not re.match(rx, itm[0]):
-                nlst.append(itm)
-        query_lst = nlst
-
-    query_str = urllib.parse.urlencode(query_lst) if query_lst else None
-    new_url = urllib.parse.urlunparse(
-        (u.scheme, u.netloc, u.path, u.params, query_str, u.fragment)
-    )
-    if new_url != url:
+    def normalize_host(self, url):
+        """Make scheme and host name lowercase and remove the default port
+        for the scheme. Returns the URL, possibly modified.
+        """
+        scheme, sep, rest = url.partition("://")
+        if not sep:
+            return url
+        end = len(rest)
+        for c in "/?#":
+            pos = rest.find(c, 0, end)
+            if pos >= 0:
+                end = pos
+        userinfo, at, host = rest[:end].rpartition("@")
+        scheme = scheme.lower()
+        host = host.lower()
+        default_port = self.DEFAULT_PORTS.get(scheme)
+        if default_port and host.endswith(default_port):
+            host = host[: -len(default_port)]
+        return scheme + sep + userinfo + at + host + rest[end:]
+
+    def clean_query_string(self, url):
+        """Remove unwanted parameters from the URL query string. Other
+        parameters are kept exactly as they were. Returns the URL, possibly
+        modified.
+        """
+        url, hash_sign, fragment = url.partition("#")
+        base, _, query = url.partition("?")
+        params = query.split("&")
+        kept = [param for param in params if not self._is_removed_param(param)]
+        if len(kept) == len(params):
+            return url + hash_sign + fragment
+        new_url = base + ("?" + "&".join(kept) if kept else "") + hash_sign + fragment
         logger.debug("query string cleanup: URL %s rewritten to %s", url, new_url)
-    return new_url
+        return new_url
+
+    def _is_removed_param(self, param):
+        name = urllib.parse.unquote_plus(param.partition("=")[0])
+        return any(rx.match(name) for rx in self.qs_remove_rx_list)
+
+
+# Formats tried with strptime() by DateParser before falling back to
+# dateutil. Ambiguous formats must be interpreted as dateutil would do.
+COMMON_DATE_FORMATS = [
+    "%Y/%m/%d",
+    "%Y/%m/%d %H:%M",
+    "%Y/%m/%d %H:%M:%S",
+    "%m/%d/%Y",
+    "%m/%d/%Y %H:%M",
+    "%d %B %Y",
+    "%d %b %Y",
+    "%B %d, %Y",
+    "%b %d, %Y",
+    "%a %b %d %Y",
+]
+
+# Strict RFC 2822 dates, as in HTTP headers and RSS feeds; anything looser
+# (e.g. with AM/PM) is left for dateutil, as email.utils would misread it.
+RFC2822_RX = re.compile(
+    r"((Mon|Tue|Wed|Thu|Fri|Sat|Sun),\s*)?\d{1,2}\s+"
+    r"(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)\s+\d{4}\s+"
+    r"\d{2}:\d{2}(:\d{2})?\s+([+-]\d{4}|UT|GMT|Z)",
+    re.IGNORECASE,
+)
+
+# Formats with names of months or weekdays, which strptime() reads in the
+# language of the current locale, while dateutil only knows English ones.
+LOCALE_DATE_DIRECTIVES = ("%a", "%A", "%b", "%B")
+
+
+class DateParser:
+    """Parse dates in unknown formats, trying the fastest methods first.
+
+    dateutil.parser can guess almost any format, but it is very slow. So,
+    try ISO 8601 (by far the most common format in metadata) and RFC 2822
+    (used in HTTP headers) first, then the strptime format that last worked
+    for the same key (i.e. the source of the dates, as a site tends to use
+    always the same format) and other common formats, leaving dateutil as
+    the last resort.
+
+    Attribute 'counters' has the number of dates parsed by every method.
+    """
+
+    def __init__(self, formats=None):
+        self.formats = formats if formats is not None else COMMON_DATE_FORMATS
+        self.counters = collections.Counter()
+        self._last_format = {}
+        self._english_locale = None
+
+    def parse(self, text, key=None):
+        """Parse a date from text. 'key' identifies the source of the date,
+        to remember its format. Raises dateutil.parser.ParserError (or
+        other ValueError) if the date can not be parsed.
+        """
+        text = text.strip()
+        date = self._parse_iso8601(text)
+        if date:
+            self.counters["iso8601"] += 1
+            return date
+
+        date = self._parse_rfc2822(text)
+        if date:
+            self.counters["rfc2822"] += 1
+            return date
+
+        date = self._parse_strptime(text, key)
+        if date:
+            self.counters["strptime"] += 1
+            return date
+
+        self.counters["dateutil"] += 1
+        return dateutil.parser.parse(text)
+
+    def _parse_iso8601(self, text):
+        if len(text) < 8 or not text[:4].isdigit():
+            return None
+        if text[-1] in "Zz":
+            # Only supported by fromisoformat() in Python 3.11+.
+            text = text[:-1] + "+00:00"
+        try:
+            return datetime.datetime.fromisoformat(text)
+        except ValueError:
+            return None
+
+    def _parse_rfc2822(self, text):
+        if not RFC2822_RX.fullmatch(text):
+            return None
+        try:
+            date = email.utils.parsedate_to_datetime(text)
+        except (TypeError, ValueError, IndexError):
+            return None
+        if date.tzinfo is None:
+            # Zone "-0000" means UTC without information about the local
+            # time; dateutil reads it as UTC too.
+            date = date.replace(tzinfo=datetime.timezone.utc)
+        return date
+
+    def _is_english_locale(self):
+        # Checked once, as the locale is set at startup.
+        if self._english_locale is None:
+            names = datetime.date(2000, 1, 1).strftime("%a %A %b %B")
+            self._english_locale = names == "Sat Saturday Jan January"
+        return self._english_locale
+
+    def _parse_strptime(self, text, key):
+        last_fmt = self._last_format.get(key)
+        candidates = [last_fmt] if last_fmt else []
+        candidates.extend(fmt for fmt in self.formats if fmt != last_fmt)
+        english = self._is_english_locale()
+        for fmt in candidates:
+            if not english and any(d in fmt for d in LOCALE_DATE_DIRECTIVES):
+                continue
+            try:
+                date = datetime.datetime.strptime(text, fmt)
+            except ValueError:
+                continue
+            self._last_format[key] = fmt
+            return date
+        return None
+
+
+_date_parser = DateParser()
+
+
+def parse_date(text, key=None):
+    """Parse a date in an unknown format with the shared DateParser."""
+    return _date_parser.parse(text, key)
 
 
 def try_date_from_str(src, date_rx, date_fmt):
@@ -97,8 +298,9 @@ def try_date_from_str(src, date_rx, date_fmt):
         if date_fmt:
             rdate = datetime.datetime.strptime(date_txt, date_fmt)
         else:
-            # No date format, use dateutil's best guess.
-            rdate = dateutil.parser.parse(date_txt)
+            # No date format, guess it. The regex identifies the source of
+            # the dates, so it is a good key for remembering their format.
+            rdate = parse_date(date_txt, date_rx)
     except (AttributeError, IndexError, ValueError, dateutil.parser.ParserError):
         logger.exception(
             "when parsing date with src=%s, fmt=%s, rx=%s", src, date_fmt, date_rx
@@ -125,6 +327,118 @@ def get_regex_first_group(regex, srcstr):
     return None
 
 
+def make_deadline(seconds):
+    """Convert a time limit, in seconds from now, to an absolute deadline
+    in the time scale used by time.monotonic(). Returns None if there is no
+    limit (i.e. 'seconds' is None).
+    """
+    if seconds is None:
+        return None
+    return time.monotonic() + seconds
+
+
+def earliest_deadline(*deadlines):
+    """Return the earliest of the given deadlines, ignoring the ones that
+    are None (i.e. no limit). Returns None if no deadline is set.
+    """
+    valid = [d for d in deadlines if d is not None]
+    return min(valid) if valid else None
+
+
+def deadline_expired(deadline):
+    """Return True if the deadline is set and was already reached."""
+    return deadline is not None and time.monotonic() >= deadline
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Context manager holding an exclusive lock for the file at 'path', so
+    concurrent invocations do not overwrite each other's changes. The lock
+    is taken on a separate file 'path'.lock, so the file itself may be
+    replaced while the lock is held.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(path + ".lock", "a") as lock_fp:
+        fcntl.flock(lock_fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_fp, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def replacing_file(filename):
+    """Context manager giving the name of a new temporary file, in the same
+    directory as 'filename', to be written by the caller; it then replaces
+    the file at once, so readers never see a partially written file. The
+    file keeps its permissions if it already exists; otherwise it gets the
+    ones open() would give it. On errors, the temporary file is removed.
+    """
+    try:
+        mode = stat.S_IMODE(os.stat(filename).st_mode)
+    except FileNotFoundError:
+        # There is no way to read the umask without also setting it.
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(filename) or ".",
+        prefix=os.path.basename(filename) + ".",
+        suffix=".tmp",
+        delete=False,
+    ) as fp:
+        tmp_filename = fp.name
+    try:
+        yield tmp_filename
+        # Only flushed to the disk if opened for writing on some systems.
+        with open(tmp_filename, "ab") as fp:
+            os.fsync(fp.fileno())
+        os.chmod(tmp_filename, mode)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+
+def write_file_atomically(filename, data):
+    """Write bytes to a file through a temporary one, as replacing_file()."""
+    with replacing_file(filename) as tmp_filename:
+        with open(tmp_filename, "wb") as fp:
+            fp.write(data)
+
+
+def get_peak_memory_usage(children=False):
+    """Return the peak resident set size, in kilobytes, of this process (or
+    of its terminated child processes), or None if it is not available.
+    """
+    if resource is None:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    maxrss = resource.getrusage(who).ru_maxrss
+    if sys.platform == "darwin":
+        # In bytes, not kilobytes, on macOS.
+        maxrss //= 1024
+    return maxrss
+
+
+def get_memory_usage():
+    """Return the current resident set size of this process, in kilobytes,
+    or None if it is not available (i.e. on systems without /proc). The
+    peak size is not a replacement, as it never goes down.
+    """
+    try:
+        with open("/proc/self/statm") as fp:
+            pages = int(fp.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
 def get_top_level_logger():
     """Get a logger for the top level module name."""
     return logging.getLogger(__name__.split(".", 1)[0])